@@ -1,16 +1,27 @@
-import json
+import time
+started_at = time.time() # taken before the imports below, for time to first alert
+
 import logging
-import os
 import sys
-import time
 
 from datetime import datetime
-from pgoapi import PGoApi
 
+from pokecells import Pokecells
 from pokeconfig import Pokeconfig
-from pokedata import json_deserializer, json_serializer
-from pokesearch import Pokesearch
+from pokedata import Pokedata
+from pokedelivery import Pokedelivery
+from pokeindex import Pokeindex
+from pokemetrics import Pokemetrics
+from pokepipeline import Pokepipeline
+from pokeplan import get_heat, load_plans, order_by_heat, plan_regions, save_plans
+from pokepool import Pokepool
+from pokereplay import Pokefakeapi, Pokerecorder, load_recording
+from pokesearch import Pokesearch, DEFAULT_VISIBLE_RANGE_METERS
+from pokesent import Pokesent
+from pokeshard import Pokeshards
 from pokeslack import Pokeslack
+from pokespawns import Pokespawns, SPAWN_CYCLE_SECONDS
+from pokestore import Pokestore
 from pokeutil import get_pos_by_name
 
 logger = logging.getLogger(__name__)
@@ -23,6 +34,7 @@ if __name__ == '__main__':
     logging.getLogger('pgoapi.rpc_api').setLevel(logging.WARNING)
 
     logging.info('Pokeslack starting...')
+    Pokeslack.started_at = started_at
 
     config = Pokeconfig()
     config.load_config('.env')
@@ -37,34 +49,127 @@ if __name__ == '__main__':
 
     # debug vars, used to test slack integration w/o waiting
     use_cache = False
-    cached_filename = 'cached_pokedata.json'
+    sightings_filename = 'sightings.db'
     search_timeout = 30
+    spawns_filename = 'spawnpoints.json'
+    sent_filename = 'sent_pokemon.log'
+    plans_filename = 'scan_plans.json'
 
-    position, address = get_pos_by_name(location_name)
+    for region in config.regions:
+        region.position, address = get_pos_by_name(region.location_name)
+        logger.info('region %s location_name: %s', region.name, address)
+    # the first region is the default position for distances
+    position = config.regions[0].position
     config.position = position
-    logger.info('location_name: %s', address)
 
-    api = PGoApi()
-    pokesearch = Pokesearch(api, auth_service, username, password, position)
-    pokeslack = Pokeslack(rarity_limit, slack_webhook_url)
+    # load the static data up front so the scan loop never waits on it
+    Pokedata.load()
+    load_plans(plans_filename)
+    plan_regions(config.regions, DEFAULT_VISIBLE_RANGE_METERS)
+    save_plans(plans_filename)
+
+    if config.replay_filename:
+        # answer map requests from a recording instead of the servers
+        records = load_recording(config.replay_filename)
+        make_api = lambda: Pokefakeapi(records)
+    else:
+        # pgoapi pulls in protobuf and friends, only import it once the config is good
+        from pgoapi import PGoApi
+        make_api = PGoApi
+    if config.record_filename:
+        logger.info('recording map responses to %s', config.record_filename)
+        make_api = lambda make_api=make_api: Pokerecorder(make_api(), config.record_filename)
+
+    # cell timestamps are shared by every account and kept across scans
+    pokecells = Pokecells()
+    if config.shards:
+        # every shard process logs in on its own, taking the accounts in turn
+        accounts = [config.accounts[i % len(config.accounts)] for i in xrange(config.shards)]
+        make_searches = [lambda account=account: Pokesearch(make_api(), account[0], account[1], account[2], position) for account in accounts]
+        logger.info('scanning with %s shard processes', config.shards)
+        # forking a process with other threads running can deadlock it, the
+        # shards start before any of ours, with the metrics already on
+        Pokemetrics.enabled = bool(config.metrics_port)
+        pokesearch = Pokeshards(make_searches, position)
+    else:
+        pokesearches = [Pokesearch(make_api(), service, user, pw, position, pokecells) for service, user, pw in config.accounts]
+        if len(pokesearches) > 1:
+            logger.info('scanning with %s accounts', len(pokesearches))
+            pokesearch = Pokepool(pokesearches)
+        else:
+            pokesearch = pokesearches[0]
+
+    if config.metrics_port:
+        Pokemetrics.serve(config.metrics_port, config.bind_host)
+    # the live pokemon, for queries over http
+    pokeindex = Pokeindex(position)
+    if config.api_port:
+        pokeindex.serve(config.api_port, config.bind_host)
+
+    # remember what was already sent so a restart doesn't alert twice
+    pokesent = Pokesent(sent_filename)
+    pokesent.load()
+    # one delivery per webhook, slack rate limits each webhook on its own
+    pokedeliveries = {}
+    pokeslacks = []
+    for region in config.regions:
+        if not region.slack_webhook_url in pokedeliveries:
+            pokedeliveries[region.slack_webhook_url] = Pokedelivery(region.slack_webhook_url)
+        name = region.name if len(config.regions) > 1 else None
+        pokeslacks.append(Pokeslack(region.rarity_limit, region.slack_webhook_url, pokesent,
+            pokedeliveries[region.slack_webhook_url], region.position, name))
+    pokespawns = Pokespawns(spawns_filename)
+    pokespawns.load()
+    pokestore = Pokestore(sightings_filename)
 
-    if not use_cache or not os.path.exists(cached_filename):
+    if not use_cache:
         logger.info('searching starting at latlng: (%s, %s)', position[0], position[1])
-        pokesearch.login()
+        # download settings are fetched after the first map request
+        if not pokesearch.login(update_settings=False):
+            logger.error('could not login to pokemon go, giving up')
+            exit(-1)
+        for pokedelivery in pokedeliveries.values():
+            pokedelivery.start()
+        # the pipeline marks what it takes as seen, so later scans skip it
+        # unless its alert gets dropped
+        pokepipeline = Pokepipeline(pokeslacks, seen=pokesearch.seen)
+        pokepipeline.start()
+        scheduled = False
+        hot_spots = []
         while True:
+            cycle_start = time.time()
+            # in spawns mode, alternate a full scan to learn new spawn points
+            # with an hour of visits to the known ones as they come up
+            scheduled = config.scan_mode == 'spawns' and not scheduled and len(pokespawns.spawnpoints) > 0
+            if scheduled:
+                logger.info('visiting %s known spawn points as they spawn', len(pokespawns.spawnpoints))
+                visits = pokespawns.iter_visits(SPAWN_CYCLE_SECONDS, pokesearch.visible_range_meters)
+                found = pokesearch.search_plan(visits)
+            else:
+                plan = plan_regions(config.regions, pokesearch.visible_range_meters)
+                save_plans(plans_filename)
+                if config.scan_mode == 'hot':
+                    # visit the steps that had rare, late or lured pokemon last time first
+                    plan = order_by_heat(plan, hot_spots, pokesearch.visible_range_meters)
+                found = pokesearch.search_plan(plan, len(plan))
             pokemons = []
-            for pokemon in pokesearch.search(position, num_steps):
+            for pokemon in found:
                 logger.info('adding pokemon: %s', pokemon)
-                pokeslack.try_send_pokemon(pokemon, debug=False)
+                pokepipeline.put(pokemon)
+                pokeindex.add(pokemon)
+                pokespawns.record(pokemon)
                 pokemons.append(pokemon)
-            with open(cached_filename, 'w') as fp:
-                json.dump(pokemons, fp, default=json_serializer, indent=4)
+            # scans only bring up new pokemon, the heat comes from all that are still up
+            now = time.time()
+            hot_spots = [(pokemon.position[0], pokemon.position[1], get_heat(pokemon, now)) for pokemon in pokeindex.get_live(now)]
+            pokespawns.save()
+            pokestore.add(pokemons)
+            Pokemetrics.observe('cycle', time.time() - cycle_start)
             logging.info('done searching, waiting %s seconds...', search_timeout)
             time.sleep(search_timeout)
     else:
-        with open(cached_filename, 'r') as fp:
-            pokemons = json.load(fp, object_hook=json_deserializer)
-            # for pokemon in pokemons:
-                # logger.info('loaded pokemon: %s', pokemon)
-                # pokeslack.try_send_pokemon(pokemon, position, distance, debug=True)
+        pokemons = pokestore.get_live()
+        # for pokemon in pokemons:
+            # logger.info('loaded pokemon: %s', pokemon)
+            # pokeslacks[0].try_send_pokemon(pokemon, debug=True)
         logger.info('loaded cached pokemon data for %s pokemon', len(pokemons))
@@ -0,0 +1,813 @@
+import logging
+import math
+import resource
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_sent(num_keys=3000000, report_every=500000):
+    """ Adds num_keys sent pokemon to a Pokesent and reports size and peak
+    memory as it goes, which should level off once max_size is reached.
+    """
+    from pokesent import Pokesent
+    pokesent = Pokesent()
+    disappear_time = datetime.utcnow() + timedelta(minutes=15)
+    start = time.time()
+    for i in xrange(1, num_keys + 1):
+        pokesent.add('key%d' % i, disappear_time + timedelta(seconds=i % 900))
+        if i % report_every == 0:
+            print('sent: %8d keys, %6d tracked, max rss %7.1f MB, %.2fs' % (i, len(pokesent), _max_rss_mb(), time.time() - start))
+
+def bench_delivery(num_alerts=200):
+    """ Bursts num_alerts alerts through a Pokedelivery into a webhook stub
+    that rate limits every 3rd post and counts what made it.
+    """
+    from pokedelivery import Pokedelivery
+    from pokereplay import start_webhook_stub
+    url, posts = start_webhook_stub(fail_every=3)
+    pokedelivery = Pokedelivery(url, batch_window=0.5)
+    pokedelivery.start()
+    delivered = []
+    start = time.time()
+    for i in xrange(num_alerts):
+        pokedelivery.put('alert %d' % i, delivered.append)
+    pokedelivery.join()
+    print('delivery: %d alerts, %d delivered, %d dropped in %d posts (%d rate limited), %.2fs' % (
+        num_alerts, delivered.count(True), delivered.count(False), len(posts),
+        sum(1 for posted, payload, status in posts if status == 429), time.time() - start))
+
+def _make_pokemons(num_pokemons, position=(37.7749, -122.4194, 0), spread=0.01):
+    import random
+    from pokedata import Pokemon
+    now_ms = time.time() * 1000
+    random.seed(num_pokemons)
+    return [Pokemon.from_pokemon({
+        'encounter_id': i,
+        'spawnpoint_id': 'spawnpoint%d' % i,
+        'pokemon_data': {'pokemon_id': random.randint(1, 151)},
+        'latitude': position[0] + random.uniform(-spread, spread),
+        'longitude': position[1] + random.uniform(-spread, spread),
+        'last_modified_timestamp_ms': now_ms,
+        'time_till_hidden_ms': random.randint(0, 900000)
+    }) for i in xrange(num_pokemons)]
+
+def _use_config(position=(37.7749, -122.4194, 0), distance_unit='miles'):
+    from pokeconfig import Pokeconfig
+    config = Pokeconfig()
+    config.position = position
+    config.distance_unit = distance_unit
+    Pokeconfig._instance = config
+    return config
+
+def bench_distance(num_pokemons=20000):
+    """ Per pokemon should_send() against the numpy batch filter. They have
+    to agree on every pokemon that isn't closer to a cutoff than how far
+    the clock moved on between the two, from making the pokemon to
+    checking them.
+    """
+    from pokeconfig import Pokeconfig
+    from pokeslack import Pokeslack
+    _use_config()
+    pokeslack = Pokeslack(3, None)
+
+    made = time.time()
+    pokemons = _make_pokemons(num_pokemons)
+    start = time.time()
+    sendable = [pokemon for pokemon in pokemons if pokeslack.should_send(pokemon)]
+    single = time.time() - start
+    # how long after being made the pokemon were checked one by one
+    single_lags = (start - made, start + single - made)
+
+    made = time.time()
+    pokemons = _make_pokemons(num_pokemons)
+    start = time.time()
+    drift = max(abs(lag - (start - made)) for lag in single_lags)
+    batch_sendable = pokeslack.filter_sendable(pokemons)
+    batch = time.time() - start
+
+    keys = set(pokemon.key for pokemon in sendable)
+    batch_keys = set(pokemon.key for pokemon in batch_sendable)
+    disagreements = 0
+    for pokemon in pokemons:
+        if (pokemon.key in keys) != (pokemon.key in batch_keys):
+            expires_in = pokemon.disappear_time_ms / 1000.0 - start
+            travel_time = pokemon.get_distance(distance_unit='meters') * 1.1 / Pokeconfig.WALK_METERS_PER_SECOND
+            if min(abs(expires_in - travel_time), abs(expires_in - Pokeconfig.EXPIRE_BUFFER_SECONDS)) > drift:
+                disagreements += 1
+    print('distance: %d pokemon, should_send %.3fs (%d sendable), filter_sendable %.3fs (%d sendable), %.1fx, %d disagreements' % (
+        num_pokemons, single, len(sendable), batch, len(batch_sendable), single / batch, disagreements))
+    return {
+        'disagreements': disagreements
+    }
+
+def _make_map_response(num_cells=21, pokemons_per_cell=10, forts_per_cell=20, lure_every=10, position=(37.7749, -122.4194), cell_ids=None, seed=None):
+    """ A large fake GET_MAP_OBJECTS response. """
+    import random
+    now_ms = int(time.time() * 1000)
+    random.seed(seed if seed is not None else num_cells)
+    cell_ids = cell_ids or range(num_cells)
+    map_cells = []
+    for c in cell_ids:
+        forts = []
+        for f in xrange(forts_per_cell):
+            fort = {
+                'id': 'fort%d_%d' % (c, f),
+                'type': 1,
+                'enabled': True,
+                'latitude': position[0] + random.uniform(-0.01, 0.01),
+                'longitude': position[1] + random.uniform(-0.01, 0.01),
+                'last_modified_timestamp_ms': now_ms
+            }
+            if f % lure_every == 0:
+                fort['lure_info'] = {
+                    'fort_id': fort['id'],
+                    'active_pokemon_id': random.randint(1, 151),
+                    'lure_expires_timestamp_ms': now_ms + 1800000
+                }
+            forts.append(fort)
+        map_cells.append({
+            's2_cell_id': c,
+            'current_timestamp_ms': now_ms,
+            'wild_pokemons': [{
+                'encounter_id': c * 1000 + p,
+                'spawnpoint_id': 'spawnpoint%d_%d' % (c, p),
+                'pokemon_data': {'pokemon_id': random.randint(1, 151)},
+                'latitude': position[0] + random.uniform(-0.01, 0.01),
+                'longitude': position[1] + random.uniform(-0.01, 0.01),
+                'last_modified_timestamp_ms': now_ms,
+                'time_till_hidden_ms': random.randint(0, 900000)
+            } for p in xrange(pokemons_per_cell)],
+            'forts': forts
+        })
+    return {'responses': {'GET_MAP_OBJECTS': {'map_cells': map_cells}}}
+
+def bench_parse(num_responses=200):
+    """ Parses the same large responses over and over like overlapping
+    steps do, with parse_map plus dedup and with iter_map skipping seen keys.
+    With --replay the responses are the recorded map responses, taken in
+    turn.
+    """
+    from pokedata import iter_map, parse_map
+    if REPLAY_FILENAME:
+        from pokereplay import load_recording
+        responses = [record['response'] for record in load_recording(REPLAY_FILENAME)
+            if record['method'] == 'get_map_objects' and 'GET_MAP_OBJECTS' in record['response'].get('responses', {})]
+    else:
+        responses = [_make_map_response()]
+
+    start = time.time()
+    seen = {}
+    for i in xrange(num_responses):
+        pokemons = parse_map(responses[i % len(responses)])
+        for key in pokemons.keys():
+            if not key in seen:
+                seen[key] = pokemons[key]
+    parse_map_time = time.time() - start
+
+    start = time.time()
+    seen = {}
+    for i in xrange(num_responses):
+        for pokemon in iter_map(responses[i % len(responses)], seen):
+            seen[pokemon.key] = pokemon
+    iter_map_time = time.time() - start
+    print('parse: %d responses (%d distinct), parse_map %.3fs, iter_map %.3fs, %.1fx' % (
+        num_responses, len(responses), parse_map_time, iter_map_time, parse_map_time / iter_map_time))
+    return {'iter_map_seconds_per_response': iter_map_time / num_responses}
+
+def bench_records(num_sightings=100000):
+    """ Construction time and memory for num_sightings Pokemon records,
+    run it on its own so the peak rss delta is meaningful.
+    """
+    import random
+    from pokedata import Pokemon
+    now_ms = time.time() * 1000
+    random.seed(num_sightings)
+    raw_pokemons = [{
+        'encounter_id': i,
+        'spawnpoint_id': 'spawnpoint%d' % i,
+        'pokemon_data': {'pokemon_id': random.randint(1, 151)},
+        'latitude': random.uniform(-90, 90),
+        'longitude': random.uniform(-180, 180),
+        'last_modified_timestamp_ms': now_ms,
+        'time_till_hidden_ms': random.randint(0, 900000)
+    } for i in xrange(num_sightings)]
+    raw_fort = {
+        'id': 'fort',
+        'latitude': 37.7749,
+        'longitude': -122.4194,
+        'lure_info': {'active_pokemon_id': 16, 'lure_expires_timestamp_ms': now_ms}
+    }
+    Pokemon.from_pokemon(raw_pokemons[0]) # loads the pokedex
+
+    rss = _max_rss_mb()
+    start = time.time()
+    pokemons = [Pokemon.from_pokemon(raw_pokemon) for raw_pokemon in raw_pokemons]
+    from_pokemon_time = time.time() - start
+    bytes_per_sighting = (_max_rss_mb() - rss) * 1024 * 1024 / num_sightings
+
+    start = time.time()
+    for i in xrange(num_sightings):
+        Pokemon.from_pokestop(raw_fort)
+    from_pokestop_time = time.time() - start
+    print('records: %d sightings, from_pokemon %.3fs, from_pokestop %.3fs, ~%d bytes per sighting' % (
+        num_sightings, from_pokemon_time, from_pokestop_time, bytes_per_sighting))
+
+def bench_geocode(latency=0.5):
+    """ Cold and warm startup geocoding without network, the cold start
+    goes to a stand-in geocoder that answers after latency seconds.
+    """
+    import os
+    import tempfile
+    from pokeutil import get_pos_by_name
+
+    class Location:
+        latitude = 37.7749
+        longitude = -122.4194
+        altitude = 0
+        address = u'San Francisco, CA, USA'
+
+    class Geolocator:
+        def geocode(self, location_name, timeout=None):
+            time.sleep(latency)
+            return Location()
+
+    cache_filename = os.path.join(tempfile.mkdtemp(), 'geocode_cache.json')
+    timings = []
+    for i in range(2):
+        start = time.time()
+        get_pos_by_name('San Francisco', cache_filename, Geolocator())
+        timings.append(time.time() - start)
+    start = time.time()
+    get_pos_by_name('37.7749,-122.4194', cache_filename, Geolocator())
+    latlng = time.time() - start
+    os.remove(cache_filename)
+    print('geocode: cold %.3fs, warm %.4fs, coordinates %.4fs' % (timings[0], timings[1], latlng))
+
+def bench_metrics(num_calls=1000000):
+    """ Cost of a timer plus a counter per call, disabled and enabled. """
+    from pokemetrics import Pokemetrics
+    timings = []
+    for enabled in (False, True):
+        Pokemetrics.enabled = enabled
+        start = time.time()
+        for i in xrange(num_calls):
+            with Pokemetrics.timer('bench'):
+                Pokemetrics.inc('bench')
+        timings.append((time.time() - start) / num_calls * 1e6)
+    Pokemetrics.enabled = False
+    print('metrics: disabled %.2fus, enabled %.2fus per timed call' % tuple(timings))
+
+def _load_recording(position, num_steps):
+    """ The recording given with --replay, or a made up one of a scan
+    around position.
+    """
+    from pokeplan import plan_scan
+    from pokereplay import load_recording, make_recording
+    if REPLAY_FILENAME:
+        return load_recording(REPLAY_FILENAME)
+    return make_recording(plan_scan(position, num_steps, 70), lambda coord, cell_ids: _make_map_response(
+        pokemons_per_cell=3, forts_per_cell=5, position=coord, cell_ids=cell_ids, seed=cell_ids[0]))
+
+def _make_throttle():
+    # the real request delays and backoffs, a hundred times shorter
+    from pokesearch import Pokethrottle
+    return Pokethrottle(delay=0.05, min_delay=0.01, max_delay=0.3, backoff=0.02, max_backoff=0.6)
+
+def bench_scan(num_steps=5, latency=0.02, failure_rate=0.05, throttle_interval=0.03):
+    """ A full scan through Pokesearch against the fake api, which answers
+    after latency seconds, fails failure_rate of the requests and throttles
+    requests closer together than throttle_interval.
+    """
+    from pokeplan import plan_scan
+    from pokereplay import Pokefakeapi
+    from pokesearch import Pokesearch
+    position = _use_config().position
+    api = Pokefakeapi(_load_recording(position, num_steps), latency, failure_rate, seed=num_steps, throttle_interval=throttle_interval)
+    search = Pokesearch(api, 'ptc', 'username', 'password', position, throttle=_make_throttle())
+    search.login()
+    plan = plan_scan(position, num_steps, search.visible_range_meters)
+
+    start = time.time()
+    num_pokemons = sum(1 for pokemon in search.search_plan(plan, len(plan)))
+    elapsed = time.time() - start
+    print('scan: %d steps, %d pokemon, %d requests (%d failed), %.2fs, %.1f steps/s, request delay settled at %.3fs' % (
+        len(plan), num_pokemons, api.num_calls, api.num_failures, elapsed, len(plan) / elapsed, search.throttle.delay))
+    return {
+        'seconds_per_step': elapsed / len(plan)
+    }
+
+def bench_geometry(num_steps=10, visible_range_meters=70):
+    """ Hex steps plus get_cell_ids per step, the way scans used to be
+    planned, against the vectorized steps, a cold plan_scan and one loaded
+    from the plan cache.
+    """
+    import os
+    import tempfile
+    import numpy # pokeplan only imports it when needed, keep that out of the timings
+    import pokeplan
+    position = (37.7749, -122.4194, 0)
+
+    start = time.time()
+    steps = list(pokeplan.generate_location_steps(position, num_steps, visible_range_meters))
+    location_steps_time = time.time() - start
+    start = time.time()
+    for coord in steps:
+        pokeplan.get_cell_ids(coord[0], coord[1])
+    cell_ids_time = time.time() - start
+    start = time.time()
+    pokeplan.get_location_steps(position, num_steps, visible_range_meters)
+    vectorized_steps_time = time.time() - start
+
+    pokeplan._plans.clear()
+    start = time.time()
+    plan = pokeplan.plan_scan(position, num_steps, visible_range_meters)
+    plan_scan_time = time.time() - start
+
+    filename = os.path.join(tempfile.mkdtemp(), 'scan_plans.json')
+    pokeplan.save_plans(filename)
+    pokeplan._plans.clear()
+    start = time.time()
+    pokeplan.load_plans(filename)
+    pokeplan.plan_scan(position, num_steps, visible_range_meters)
+    cached_time = time.time() - start
+    os.remove(filename)
+    print('geometry: %d steps, generate_location_steps %.4fs, get_cell_ids %.4fs, get_location_steps %.4fs, plan_scan %.4fs, from cache %.4fs' % (
+        len(plan), location_steps_time, cell_ids_time, vectorized_steps_time, plan_scan_time, cached_time))
+
+    # two overlapping regions, the joined plan has to see everything the
+    # regions' own plans see
+    from pokeconfig import Pokeregion
+    from pokefilter import EARTH_RADIUS_METERS, get_distances_meters
+    regions = []
+    for i, lng_offset in enumerate((0, 0.012)):
+        region = Pokeregion('region%s' % i, '', num_steps, 0, '')
+        region.position = (position[0] + 0.003 * i, position[1] + lng_offset, 0)
+        regions.append(region)
+    start = time.time()
+    joined = pokeplan.plan_regions(regions, visible_range_meters)
+    plan_regions_time = time.time() - start
+    steps = numpy.array([coord[:2] for region in regions
+        for coord, cell_ids in pokeplan.plan_scan(region.position, region.num_steps, visible_range_meters)])
+    joined_steps = numpy.array([coord[:2] for coord, cell_ids in joined])
+    # points every fifth of the visible range over the area
+    meters_per_degree = EARTH_RADIUS_METERS * math.pi / 180
+    cos_lat = math.cos(math.radians(position[0]))
+    spacing = visible_range_meters / 5.0
+    lats = numpy.arange(steps[:, 0].min(), steps[:, 0].max(), spacing / meters_per_degree)
+    lngs = numpy.arange(steps[:, 1].min(), steps[:, 1].max(), spacing / meters_per_degree / cos_lat)
+    points = numpy.array([(lat, lng) for lat in lats for lng in lngs])
+
+    def get_nearest_meters(points, steps):
+        nearest = []
+        for chunk in xrange(0, len(points), 1000):
+            part = points[chunk:chunk + 1000]
+            meters = get_distances_meters((part[:, 0, numpy.newaxis], part[:, 1, numpy.newaxis]), steps[:, 0], steps[:, 1])
+            nearest.append(meters.min(axis=1))
+        return numpy.concatenate(nearest)
+    seen = get_nearest_meters(points, steps) <= visible_range_meters
+    missed = get_nearest_meters(points[seen], joined_steps) > visible_range_meters * (1 + pokeplan.COVER_TOLERANCE)
+    print('geometry: 2 regions, %d steps joined into %d, plan_regions %.4fs, %d of %d points seen by the regions missed' % (
+        len(steps), len(joined), plan_regions_time, missed.sum(), seen.sum()))
+    return {
+        'location_steps_seconds': vectorized_steps_time,
+        'get_cell_ids_seconds': cell_ids_time,
+        'plan_scan_seconds': plan_scan_time,
+        'cached_plan_seconds': cached_time,
+        'plan_regions_seconds': plan_regions_time,
+        'missed_points': int(missed.sum())
+    }
+
+def _run_alerts(prioritize, num_steps, latency, failure_rate, slack_latency, slack_failure_rate, rarity_limit):
+    """ Replays a scan through the pipeline and delivery as main runs them,
+    returns [(rarity, seconds from found to sent)] and the number of posts.
+    """
+    from pokedelivery import Pokedelivery
+    from pokepipeline import Pokepipeline
+    from pokeplan import plan_scan
+    from pokereplay import Pokefakeapi, start_webhook_stub
+    from pokesearch import Pokesearch
+    from pokeslack import Pokeslack
+    position = _use_config().position
+    api = Pokefakeapi(_load_recording(position, num_steps), latency, failure_rate, seed=num_steps)
+    search = Pokesearch(api, 'ptc', 'username', 'password', position, throttle=_make_throttle())
+    search.login()
+    url, posts = start_webhook_stub(latency=slack_latency, failure_rate=slack_failure_rate, seed=num_steps)
+
+    found_at = {}
+    latencies = []
+    class TimedPokeslack(Pokeslack):
+        def _sent(self, pokemon_key, pokemon):
+            Pokeslack._sent(self, pokemon_key, pokemon)
+            latencies.append((pokemon.rarity, time.time() - found_at[pokemon.key]))
+
+    pokedelivery = Pokedelivery(url)
+    pokedelivery.start()
+    pokepipeline = Pokepipeline([TimedPokeslack(rarity_limit, url, delivery=pokedelivery, position=position)], prioritize=prioritize)
+    pokepipeline.start()
+    plan = plan_scan(position, num_steps, search.visible_range_meters)
+    for pokemon in search.search_plan(plan, len(plan)):
+        found_at[pokemon.key] = time.time()
+        pokepipeline.put(pokemon)
+    pokepipeline.join()
+    pokedelivery.join()
+    return latencies, len(posts)
+
+def bench_alerts(num_steps=7, latency=0.02, failure_rate=0.05, slack_latency=0.3, slack_failure_rate=0.3, rarity_limit=1, rare=4):
+    """ Time from a pokemon coming out of the scan to its alert landing in
+    the webhook stub, in the order found and prioritized, overall and for
+    pokemon of rarity rare and up. The webhook is slow and flaky enough for
+    alerts to back up.
+    """
+    results = {}
+    for prioritize in (False, True):
+        latencies, num_posts = _run_alerts(prioritize, num_steps, latency, failure_rate, slack_latency, slack_failure_rate, rarity_limit)
+        if not latencies:
+            print('alerts: nothing was sent')
+            return {}
+        all_seconds = sorted(seconds for rarity, seconds in latencies)
+        rare_seconds = [seconds for rarity, seconds in latencies if rarity >= rare] or [0]
+        mean = sum(all_seconds) / len(all_seconds)
+        p95 = all_seconds[int(len(all_seconds) * 0.95)]
+        rare_mean = sum(rare_seconds) / len(rare_seconds)
+        print('alerts: %s, %d sent in %d posts, latency mean %.2fs, p95 %.2fs, max %.2fs, rarity %d+ mean %.2fs' % (
+            'prioritized' if prioritize else 'in order found', len(all_seconds), num_posts, mean, p95, all_seconds[-1], rare, rare_mean))
+    return {
+        'mean_alert_seconds': mean,
+        'p95_alert_seconds': p95,
+        'mean_rare_alert_seconds': rare_mean
+    }
+
+class _Fakeworld(object):
+    """ Made up spawns around the steps of plan for Pokefakeapi to answer
+    from: rare pokemon keep spawning at a few nests in the outer rings, on
+    average every nest_interval seconds, and common ones anywhere, each up
+    for duration seconds.
+    """
+    def __init__(self, plan, duration, num_nests=3, nest_interval=1.0, common_interval=0.05, horizon=60, seed=0):
+        import random
+        from pokedata import Pokedata
+        Pokedata.load()
+        rare_ids = [i for i, rarity in enumerate(Pokedata.rarities) if rarity >= 4]
+        common_ids = [i for i, rarity in enumerate(Pokedata.rarities) if 1 <= rarity < 3]
+        random.seed(seed)
+        self.start = time.time()
+        self.duration = duration
+        self.spawns = []
+        outer = plan[len(plan) * 2 / 3:]
+        for coord, cell_ids in random.sample(outer, num_nests):
+            t = random.uniform(0, nest_interval)
+            while t < horizon:
+                self.spawns.append((self.start + t, coord[0], coord[1], random.choice(rare_ids)))
+                # not on a fixed beat, or a scan of about the same length locks onto it
+                t += random.uniform(0.5, 1.5) * nest_interval
+        t = 0
+        while t < horizon:
+            coord = random.choice(plan)[0]
+            self.spawns.append((self.start + t, coord[0], coord[1], random.choice(common_ids)))
+            t += common_interval
+        # the level 15 cell each spawn is in, responses are grouped by cell
+        from s2sphere import CellId, LatLng
+        self.cell_ids = [CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).parent(15).id()
+            for spawned, lat, lng, pokemon_id in self.spawns]
+
+    def get_map_response(self, position, visible_range_meters=70):
+        from pokeplan import get_approx_meters
+        now = time.time()
+        map_cells = {}
+        for i, (spawned, lat, lng, pokemon_id) in enumerate(self.spawns):
+            if spawned <= now < spawned + self.duration and get_approx_meters(position, (lat, lng)) <= visible_range_meters:
+                cell = map_cells.setdefault(self.cell_ids[i], {
+                    's2_cell_id': self.cell_ids[i],
+                    'current_timestamp_ms': int(now * 1000),
+                    'wild_pokemons': [],
+                    'forts': []
+                })
+                cell['wild_pokemons'].append({
+                    'encounter_id': i,
+                    'spawnpoint_id': 'spawnpoint%d' % i,
+                    'pokemon_data': {'pokemon_id': pokemon_id},
+                    'latitude': lat,
+                    'longitude': lng,
+                    'last_modified_timestamp_ms': int(now * 1000),
+                    'time_till_hidden_ms': int((spawned + self.duration - now) * 1000)
+                })
+        return {'responses': {'GET_MAP_OBJECTS': {'map_cells': map_cells.values()}}}
+
+def _run_heat(hot, num_steps, window, duration, nest_interval, pause, latency, rare):
+    """ Scans a made up world over and over, pausing in between like main
+    does, in spiral or hot order after the first scan, until window seconds
+    after the first scan. Returns the seconds from spawn to first found of
+    every rare pokemon that spawned and disappeared within the window,
+    duration for the ones never found, and how many were found.
+    """
+    from base64 import b64decode
+    from pokedata import Pokedata
+    from pokeindex import Pokeindex
+    from pokeplan import get_heat, order_by_heat, plan_scan
+    from pokereplay import Pokefakeapi, make_recording
+    from pokesearch import Pokesearch, Pokethrottle
+    position = _use_config().position
+    plan = plan_scan(position, num_steps, 70)
+    world = _Fakeworld(plan, duration, nest_interval=nest_interval)
+    class Worldapi(Pokefakeapi):
+        def call(self):
+            if self.pending[0] == 'get_map_objects':
+                self.pending = None
+                time.sleep(self.latency)
+                return world.get_map_response(self.position)
+            return Pokefakeapi.call(self)
+    api = Worldapi(make_recording([], None), latency)
+    # a fixed delay, so both orders scan at the same pace
+    search = Pokesearch(api, 'ptc', 'username', 'password', position, throttle=Pokethrottle(0.01, 0.01, 0.01))
+    search.login()
+
+    # like main, new pokemon are marked seen and the heat comes from all the live ones
+    pokeindex = Pokeindex(position)
+    found = {}
+    hot_spots = []
+    start = end = None
+    while end is None or time.time() < end:
+        ordered = order_by_heat(plan, hot_spots, 70) if hot and start else plan
+        for pokemon in search.search_plan(ordered):
+            search.seen.add_pokemon(pokemon)
+            pokeindex.add(pokemon)
+            spawn = int(b64decode(pokemon.encounter_id))
+            if start and pokemon.rarity >= rare and not spawn in found:
+                found[spawn] = time.time() - world.spawns[spawn][0]
+            if end and time.time() >= end:
+                break
+        if start is None:
+            start = time.time()
+            end = start + window
+        now = time.time()
+        hot_spots = [(pokemon.position[0], pokemon.position[1], get_heat(pokemon, now)) for pokemon in pokeindex.get_live(now)]
+        time.sleep(max(0, min(pause, end - now)))
+    spawns = [i for i, (spawned, lat, lng, pokemon_id) in enumerate(world.spawns)
+        if Pokedata.rarities[pokemon_id] >= rare and start <= spawned and spawned + duration <= end]
+    return [found.get(i, duration) for i in spawns], sum(1 for i in spawns if i in found)
+
+def bench_heat(num_steps=6, window=30, duration=3, nest_interval=2, pause=1, latency=0.01, rare=4):
+    """ Mean seconds from a rare pokemon spawning to the scan finding it,
+    scanning in spiral order and hottest first for the same window of time,
+    in a made up world where rare pokemon spawn at a few nests every
+    nest_interval seconds and stay up for duration seconds, a scan takes
+    about two seconds. A rare pokemon that is never found counts as
+    duration seconds, so visiting hot steps twice has to pay for the
+    longer scans.
+    """
+    results = {}
+    for hot in (False, True):
+        latencies, num_found = _run_heat(hot, num_steps, window, duration, nest_interval, pause, latency, rare)
+        mean = sum(latencies) / len(latencies) if latencies else float('inf')
+        print('heat: %s, found %d of %d rare spawns in %ds, spawn to alert mean %.2fs counting misses as %ds' % (
+            'hottest first' if hot else 'spiral order', num_found, len(latencies), window, mean, duration))
+        results['hot' if hot else 'spiral'] = mean
+    return {
+        'spiral_spawn_to_alert_seconds': results['spiral'],
+        'hot_spawn_to_alert_seconds': results['hot'],
+        'hot_to_spiral_ratio': results['hot'] / results['spiral']
+    }
+
+def bench_shards(num_steps=8, latency=0.01, shard_counts=(1, 2, 4)):
+    """ Steps per second for a scan against the fake api with large
+    responses, in one process and sharded over worker processes. The
+    requests overlap on any machine, the parsing only with more cores.
+    The map requests timed by the workers have to show up in the metrics.
+    """
+    import multiprocessing
+    from pokemetrics import Pokemetrics
+    from pokeplan import plan_scan
+    from pokereplay import Pokefakeapi, make_recording
+    from pokesearch import Pokesearch, Pokethrottle
+    from pokeshard import Pokeshards
+    position = _use_config().position
+    plan = plan_scan(position, num_steps, 70)
+    records = make_recording(plan, lambda coord, cell_ids: _make_map_response(
+        pokemons_per_cell=30, forts_per_cell=30, position=coord, cell_ids=cell_ids, seed=cell_ids[0]))
+    make_search = lambda: Pokesearch(Pokefakeapi(records, latency), 'ptc', 'username', 'password', position, throttle=Pokethrottle(0, 0, 0))
+
+    search = make_search()
+    search.login()
+    start = time.time()
+    num_pokemons = sum(1 for pokemon in search.search_plan(plan))
+    single = time.time() - start
+    print('shards: %d steps, %d pokemon, %d cores, one process %.2fs, %.1f steps/s' % (
+        len(plan), num_pokemons, multiprocessing.cpu_count(), single, len(plan) / single))
+
+    results = {}
+    for num_shards in shard_counts:
+        Pokemetrics.enabled = True
+        Pokemetrics.take()
+        pokeshards = Pokeshards([make_search] * num_shards, position)
+        pokeshards.login()
+        start = time.time()
+        num_pokemons = sum(1 for pokemon in pokeshards.search_plan(plan))
+        elapsed = time.time() - start
+        histograms, counters, gauges = Pokemetrics.take()
+        Pokemetrics.enabled = False
+        num_timed = histograms['get_map_objects'][2] if 'get_map_objects' in histograms else 0
+        print('shards: %d processes %.2fs, %.1f steps/s, %.1fx, %d pokemon, %d map requests in the metrics' % (
+            num_shards, elapsed, len(plan) / elapsed, single / elapsed, num_pokemons, num_timed))
+        results['shards_%d_seconds_per_step' % num_shards] = elapsed / len(plan)
+        results['shards_%d_untimed_steps' % num_shards] = len(plan) - num_timed
+    return results
+
+def bench_cycles(num_steps=8, num_cycles=3):
+    """ Repeated scans over the same responses, the way pokemon stay up
+    across cycles, forgetting what was seen after each scan and keeping it.
+    Every pokemon found is formatted like main logs it and marked seen like
+    the pipeline does.
+    """
+    from pokeplan import plan_scan
+    from pokereplay import Pokefakeapi, make_recording
+    from pokesearch import Pokesearch, Pokethrottle
+    from pokesent import Pokeseen
+    position = _use_config().position
+    plan = plan_scan(position, num_steps, 70)
+    records = make_recording(plan, lambda coord, cell_ids: _make_map_response(
+        pokemons_per_cell=30, forts_per_cell=30, position=coord, cell_ids=cell_ids, seed=cell_ids[0]))
+    results = {}
+    for keep in (False, True):
+        search = Pokesearch(Pokefakeapi(records), 'ptc', 'username', 'password', position, throttle=Pokethrottle(0, 0, 0))
+        search.login()
+        timings = []
+        counts = []
+        for cycle in xrange(num_cycles):
+            if not keep:
+                search.seen = Pokeseen()
+            start = time.time()
+            count = 0
+            for pokemon in search.search_plan(plan):
+                str(pokemon)
+                search.seen.add_pokemon(pokemon)
+                count += 1
+            counts.append(count)
+            timings.append(time.time() - start)
+        print('cycles: %s, pokemon per cycle %s, seconds per cycle %s' % (
+            'keeping seen' if keep else 'fresh each cycle', counts, ' '.join('%.3f' % timing for timing in timings)))
+        results['later_cycle_seconds' if keep else 'fresh_cycle_seconds'] = sum(timings[1:]) / (num_cycles - 1)
+    return {'later_cycle_seconds': results['later_cycle_seconds']}
+
+def bench_api(num_pokemons=20000, spread=0.03, num_queries=2000, radius_meters=300, num_clients=4, duration=3):
+    """ Queries for pokemon within radius_meters of random points, against
+    the grid index and a scan over every pokemon, then num_clients keep-alive
+    http clients querying the api for duration seconds. The pokemon are as
+    dense as in a busy park, over a few regions' worth of area.
+    """
+    import httplib
+    import json
+    import random
+    from pokeindex import Pokeindex
+    position = _use_config().position
+    pokemons = _make_pokemons(num_pokemons, position, spread)
+    pokeindex = Pokeindex(position)
+    start = time.time()
+    for pokemon in pokemons:
+        pokeindex.add(pokemon)
+    add = (time.time() - start) / num_pokemons
+    rand = random.Random(num_queries)
+    queries = [(position[0] + rand.uniform(-spread, spread), position[1] + rand.uniform(-spread, spread), rand.randint(0, 4))
+        for i in xrange(num_queries)]
+
+    # pokemon expire as it runs, both checks count the ones live at start
+    start = time.time()
+    num_found = [len(pokeindex.query(lat, lng, radius_meters, rarity, start)) for lat, lng, rarity in queries]
+    indexed = (time.time() - start) / num_queries
+    # the same queries as one numpy pass over every pokemon, to check the grid misses none
+    import numpy as np
+    from pokefilter import get_distances_meters
+    latitudes = np.array([pokemon.position[0] for pokemon in pokemons])
+    longitudes = np.array([pokemon.position[1] for pokemon in pokemons])
+    rarities = np.array([pokemon.rarity for pokemon in pokemons])
+    disappear_times = np.array([pokemon.disappear_time_ms for pokemon in pokemons])
+    now_ms = start * 1000
+    start = time.time()
+    for (lat, lng, rarity), count in zip(queries, num_found):
+        live = (rarities >= rarity) & (disappear_times > now_ms)
+        expected = np.count_nonzero(live & (get_distances_meters((lat, lng), latitudes, longitudes) <= radius_meters))
+        assert expected == count, (expected, count)
+    scanned = (time.time() - start) / num_queries
+    print('api: %d pokemon, %.1fus per add, %d found per query, query %.3fms indexed, %.1fms scanning them all' % (
+        len(pokeindex), add * 1e6, sum(num_found) / num_queries, indexed * 1000, scanned * 1000))
+
+    server = pokeindex.serve(0)
+    counts = [0] * num_clients
+    def client(n):
+        connection = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        end = time.time() + duration
+        while time.time() < end:
+            lat, lng, rarity = queries[counts[n] % num_queries]
+            connection.request('GET', '/pokemon?lat=%s&lng=%s&radius=%s&rarity=%s' % (lat, lng, radius_meters, rarity))
+            response = connection.getresponse()
+            assert response.status == 200 and 'pokemon' in json.loads(response.read())
+            counts[n] += 1
+        connection.close()
+    threads = [threading.Thread(target=client, args=(n,)) for n in xrange(num_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    qps = sum(counts) / float(duration)
+    print('api: %d http clients, %.0f queries/s' % (num_clients, qps))
+    return {'query_seconds': indexed, 'http_seconds_per_query': 1 / qps}
+
+BENCHMARKS = {
+    'api': bench_api,
+    'cycles': bench_cycles,
+    'shards': bench_shards,
+    'heat': bench_heat,
+    'alerts': bench_alerts,
+    'geometry': bench_geometry,
+    'scan': bench_scan,
+    'metrics': bench_metrics,
+    'geocode': bench_geocode,
+    'records': bench_records,
+    'parse': bench_parse,
+    'distance': bench_distance,
+    'delivery': bench_delivery,
+    'sent': bench_sent
+}
+
+# upper limits for what the benchmarks return, --check fails on anything
+# above them. measured on a laptop with plenty of headroom, the point is to
+# catch regressions by a factor, not by a few percent
+THRESHOLDS = {
+    'api': {
+        'query_seconds': 0.001,
+        'http_seconds_per_query': 0.01
+    },
+    'cycles': {
+        'later_cycle_seconds': 0.1
+    },
+    'shards': {
+        'shards_4_seconds_per_step': 0.01,
+        'shards_4_untimed_steps': 0
+    },
+    'heat': {
+        # hot first has to beat the spiral
+        'hot_to_spiral_ratio': 0.9
+    },
+    'alerts': {
+        'mean_alert_seconds': 20.0,
+        'p95_alert_seconds': 40.0,
+        'mean_rare_alert_seconds': 8.0
+    },
+    'distance': {
+        'disagreements': 0
+    },
+    'geometry': {
+        'location_steps_seconds': 0.05,
+        'get_cell_ids_seconds': 0.5,
+        'plan_scan_seconds': 0.5,
+        'cached_plan_seconds': 0.05,
+        'plan_regions_seconds': 1.0,
+        'missed_points': 0
+    },
+    'parse': {
+        'iter_map_seconds_per_response': 0.005
+    },
+    'scan': {
+        'seconds_per_step': 0.15
+    }
+}
+
+REPLAY_FILENAME = None
+
+def check_thresholds(name, results):
+    failed = []
+    for metric, limit in sorted(THRESHOLDS.get(name, {}).items()):
+        value = (results or {}).get(metric)
+        if value is None or value > limit:
+            failed.append('%s %s is %s, limit %s' % (name, metric, value, limit))
+    return failed
+
+if __name__ == '__main__':
+    # python pokebench.py [--check] [--replay recorded.jsonl] [name ...]
+    logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+    args = sys.argv[1:]
+    check = '--check' in args
+    if check:
+        args.remove('--check')
+    if '--replay' in args:
+        i = args.index('--replay')
+        REPLAY_FILENAME = args[i + 1]
+        del args[i:i + 2]
+    names = args or sorted(BENCHMARKS.keys())
+    failed = []
+    for name in names:
+        results = BENCHMARKS[name]()
+        if check:
+            failed.extend(check_thresholds(name, results))
+    for failure in failed:
+        print('FAILED: %s' % failure)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+EXPIRE_INTERVAL_SECONDS = 60 # sweeping every cell for expired pokemon is slow, once a minute is plenty
+
+class Pokecells:
+    """ Remembers the last server timestamp seen for each S2 cell so map
+    requests only ask for what changed, and keeps the merged contents of
+    every cell fetched so far: the wild pokemon until they disappear and
+    the lured pokestops until their lure runs out.
+
+    The servers only return what is visible from where a request is made,
+    so a timestamp only holds for the cell as seen from that position. They
+    are kept per (cell, position), which costs nothing across scans since a
+    plan's steps are the same every time, but a step that overlaps a cell
+    another step just fetched still asks for all of it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timestamps = {}
+        self.cells = {}
+        self.expired_at = 0
+
+    def get_timestamps(self, coord, cell_ids):
+        with self.lock:
+            return [self.timestamps.get((cell_id, coord[0], coord[1]), 0) for cell_id in cell_ids]
+
+    def merge(self, coord, response_dict):
+        map_cells = response_dict['responses']['GET_MAP_OBJECTS'].get('map_cells', [])
+        with self.lock:
+            for cell in map_cells:
+                cell_id = cell['s2_cell_id']
+                cached = self.cells.setdefault(cell_id, {
+                    'wild_pokemons': {},
+                    'forts': {}
+                })
+                for p in cell.get('wild_pokemons', []):
+                    cached['wild_pokemons'][p['encounter_id']] = p
+                for f in cell.get('forts', []):
+                    # only lured pokestops have pokemon, a fort that lost its lure is dropped
+                    if f.get('lure_info'):
+                        cached['forts'][f['id']] = f
+                    else:
+                        cached['forts'].pop(f['id'], None)
+                if cell.get('current_timestamp_ms'):
+                    self.timestamps[(cell_id, coord[0], coord[1])] = cell['current_timestamp_ms']
+            if time.time() - self.expired_at >= EXPIRE_INTERVAL_SECONDS:
+                self._expire()
+
+    def get_map_response(self, cell_ids):
+        """ The merged contents of cell_ids, shaped like a GET_MAP_OBJECTS
+        response.
+        """
+        with self.lock:
+            map_cells = []
+            for cell_id in cell_ids:
+                if cell_id in self.cells:
+                    cached = self.cells[cell_id]
+                    map_cells.append({
+                        's2_cell_id': cell_id,
+                        'wild_pokemons': cached['wild_pokemons'].values(),
+                        'forts': cached['forts'].values()
+                    })
+            return {'responses': {'GET_MAP_OBJECTS': {'map_cells': map_cells}}}
+
+    def _expire(self):
+        self.expired_at = time.time()
+        now_ms = self.expired_at * 1000
+        for cell_id, cached in self.cells.items():
+            wild_pokemons = cached['wild_pokemons']
+            for encounter_id, p in wild_pokemons.items():
+                if p['last_modified_timestamp_ms'] + p['time_till_hidden_ms'] < now_ms:
+                    del wild_pokemons[encounter_id]
+            forts = cached['forts']
+            for fort_id, f in forts.items():
+                if f['lure_info'].get('lure_expires_timestamp_ms', 0) < now_ms:
+                    del forts[fort_id]
+            if not wild_pokemons and not forts:
+                del self.cells[cell_id]
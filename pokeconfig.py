@@ -1,3 +1,4 @@
+import json
 import os
 import logging
 
@@ -10,6 +11,8 @@ class Pokeconfig:
     EXPIRE_BUFFER_SECONDS = 5 # if a pokemon expires in 5 seconds or less (includes negative/stale pokemon), dont send it
     DEFAULT_NUM_STEPS = 5
     DEFAULT_DISTANCE_UNIT = 'miles'
+    DEFAULT_SCAN_MODE = 'hex'
+    DEFAULT_BIND_HOST = '127.0.0.1' # only this machine can reach the http servers
 
     # configured via env
     auth_service = None
@@ -20,7 +23,16 @@ class Pokeconfig:
     slack_webhook_url = None
     num_steps = DEFAULT_NUM_STEPS
     distance_unit = DEFAULT_DISTANCE_UNIT
+    scan_mode = DEFAULT_SCAN_MODE
     position = ()
+    accounts = []
+    regions = []
+    bind_host = DEFAULT_BIND_HOST
+    metrics_port = None
+    api_port = None
+    shards = 0
+    record_filename = None
+    replay_filename = None
 
     def load_config(self, config_path):
         is_local = False
@@ -51,6 +63,16 @@ class Pokeconfig:
             self.location_name = str(env['LOCATION_NAME'])
             self.rarity_limit = int(env['RARITY_LIMIT'])
             self.slack_webhook_url = str(env['SLACK_WEBHOOK_URL'])
+            self.accounts = [(self.auth_service, self.username, self.password)]
+            if 'ACCOUNTS' in env:
+                # extra scan accounts as service:username:password, comma separated
+                for account in str(env['ACCOUNTS']).split(','):
+                    try:
+                        auth_service, username, password = account.strip().split(':', 2)
+                    except ValueError:
+                        logging.error('ACCOUNTS entries must look like service:username:password!')
+                        exit(-1)
+                    self.accounts.append((auth_service, username, password))
             if 'NUM_STEPS' in env:
                 self.num_steps = int(env['NUM_STEPS'])
             else:
@@ -59,6 +81,35 @@ class Pokeconfig:
                 self.distance_unit = str(env['DISTANCE_UNIT'])
             else:
                 logging.warn('DISTANCE_UNIT not defined defaulting to: %s', self.distance_unit)
+            if 'SCAN_MODE' in env:
+                self.scan_mode = str(env['SCAN_MODE'])
+            if 'BIND_HOST' in env:
+                self.bind_host = str(env['BIND_HOST'])
+            if 'METRICS_PORT' in env:
+                self.metrics_port = int(env['METRICS_PORT'])
+            if 'API_PORT' in env:
+                self.api_port = int(env['API_PORT'])
+            if 'SHARDS' in env:
+                self.shards = int(env['SHARDS'])
+            if 'RECORD_FILENAME' in env:
+                self.record_filename = str(env['RECORD_FILENAME'])
+            if 'REPLAY_FILENAME' in env:
+                self.replay_filename = str(env['REPLAY_FILENAME'])
+            if 'REGIONS' in env:
+                # a json list of regions, anything left out comes from the settings above
+                try:
+                    self.regions = [self._load_region(region) for region in json.loads(env['REGIONS'])]
+                except ValueError:
+                    logging.error('REGIONS must be a json list of regions!')
+                    exit(-1)
+                # region names prefix the sent keys, regions sharing one would skip each other's alerts
+                names = [region.name for region in self.regions]
+                duplicates = sorted(set(name for name in names if names.count(name) > 1))
+                if duplicates:
+                    logging.error('REGIONS must have unique names, give the regions named %s a name of their own!', ', '.join(duplicates))
+                    exit(-1)
+            else:
+                self.regions = [self._load_region({})]
         except KeyError as ke:
             logging.error('key must be defined in config: %s!', ke)
             exit(-1)
@@ -68,9 +119,32 @@ class Pokeconfig:
         for key, value in vars(self).iteritems():
             if key == 'password':
                 value = '****'
+            elif key == 'accounts':
+                value = [username for _, username, _ in value]
+            elif key == 'regions':
+                value = [region.name for region in value]
             logger.info('%s=%s', key, value)
 
+    def _load_region(self, region):
+        location_name = str(region.get('location_name', self.location_name))
+        return Pokeregion(
+            str(region.get('name', location_name)),
+            location_name,
+            int(region.get('num_steps', self.num_steps)),
+            int(region.get('rarity_limit', self.rarity_limit)),
+            str(region.get('slack_webhook_url', self.slack_webhook_url)))
+
     _instance = None
     @staticmethod
     def get():
         return Pokeconfig._instance
+
+class Pokeregion:
+    """ One area to watch, with its own center, steps, rarity limit and webhook. """
+    def __init__(self, name, location_name, num_steps, rarity_limit, slack_webhook_url):
+        self.name = name
+        self.location_name = location_name
+        self.num_steps = num_steps
+        self.rarity_limit = rarity_limit
+        self.slack_webhook_url = slack_webhook_url
+        self.position = ()
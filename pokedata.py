@@ -1,73 +1,105 @@
 import calendar
 import csv
 
+from array import array
 from base64 import b64encode
 from datetime import datetime
-from geopy.distance import vincenty
 
 from pokeconfig import Pokeconfig
 
+METERS_PER_MILE = 1609.344
+
 class Pokedata:
-    pokedata = None
+    # pokedex tables indexed by pokemon_id, built once from pokedata.csv
+    names = None
+    rarities = None
+
     @staticmethod
-    def get(pokemon_id):
-        if not Pokedata.pokedata:
-            Pokedata.pokedata = {}
+    def load():
+        if Pokedata.names is None:
+            rows = []
             with open('pokedata.csv', 'rU') as csvfile:
                 reader = csv.reader(csvfile)
                 for row in reader:
-                    id = int(row[0])
-                    name = row[1]
-                    rarity = int(row[2])
-                    Pokedata.pokedata[id] = {
-                        'name': name,
-                        'rarity': rarity
-                    }
-        return Pokedata.pokedata[pokemon_id]
-
-class Pokemon:
-    position = ()
-    latitude = None
-    longitude = None
-    pokemon_id = 0
-    encounter_id = None
-    spawnpoint_id = None
-    disappear_time = None
-    from_lure = False
-    pokestop_id = 0
-    name = None
-    rarity = 1
-    key = None
+                    rows.append((int(row[0]), row[1], int(row[2])))
+            size = max(id for id, name, rarity in rows) + 1
+            names = [None] * size
+            rarities = array('b', [0] * size)
+            for id, name, rarity in rows:
+                names[id] = name
+                rarities[id] = rarity
+            Pokedata.rarities = rarities
+            Pokedata.names = tuple(names)
 
     @staticmethod
-    def from_pokemon(pokemon):
-        p = Pokemon()
-        p.encounter_id =  b64encode(str(pokemon['encounter_id']))
-        p.spawnpoint_id = pokemon['spawnpoint_id']
-        p.pokemon_id = pokemon['pokemon_data']['pokemon_id']
-        p.position = (pokemon['latitude'], pokemon['longitude'], 0)
-        p.disappear_time =  datetime.utcfromtimestamp(
-            (pokemon['last_modified_timestamp_ms'] +
-             pokemon['time_till_hidden_ms']) / 1000.0)
-        p._get_pokedata()
-        return p
+    def get(pokemon_id):
+        Pokedata.load()
+        if pokemon_id >= len(Pokedata.names) or Pokedata.names[pokemon_id] is None:
+            raise KeyError(pokemon_id)
+        return {
+            'name': Pokedata.names[pokemon_id],
+            'rarity': Pokedata.rarities[pokemon_id]
+        }
+
+class Pokemon(object):
+    __slots__ = ('position', 'pokemon_id', 'encounter_id', 'spawnpoint_id', 'disappear_time_ms',
+        '_disappear_time', 'from_lure', 'pokestop_id', 'key', 'distance')
+
+    def __init__(self, pokemon_id=0, position=(), disappear_time_ms=None, encounter_id=None, spawnpoint_id=None, from_lure=False, pokestop_id=0):
+        if Pokedata.names is None:
+            Pokedata.load()
+        # fail while parsing, like looking the pokemon up did, not later on its name or rarity
+        if not 0 <= pokemon_id < len(Pokedata.names) or Pokedata.names[pokemon_id] is None:
+            raise KeyError(pokemon_id)
+        self.position = position
+        self.pokemon_id = pokemon_id
+        self.encounter_id = encounter_id
+        self.spawnpoint_id = spawnpoint_id
+        self.disappear_time_ms = disappear_time_ms
+        self._disappear_time = None
+        self.from_lure = from_lure
+        self.pokestop_id = pokestop_id
+        self.key = self._get_key()
+        self.distance = None # (position, meters) of the last distance computed
 
     @staticmethod
-    def from_pokestop(pokestop):
-        p = Pokemon()
-        p.position = (pokestop['latitude'], pokestop['longitude'], 0)
-        p.pokemon_id = pokestop['active_pokemon_id']
-        p.disappear_time = pokestop['lure_expiration']
-        p.from_lure = True
-        p.pokestop_id = pokestop['pokestop_id']
-        p._get_pokedata()
-        return p
-
-    def _get_pokedata(self):
-        pokedata = Pokedata.get(self.pokemon_id)
-        self.name = pokedata['name']
-        self.rarity = pokedata['rarity']
-        self.key = self._get_key()
+    def from_pokemon(pokemon, encounter_id=None):
+        return Pokemon(
+            pokemon['pokemon_data']['pokemon_id'],
+            (pokemon['latitude'], pokemon['longitude'], 0),
+            pokemon['last_modified_timestamp_ms'] + pokemon['time_till_hidden_ms'],
+            encounter_id=encounter_id or b64encode(str(pokemon['encounter_id'])),
+            spawnpoint_id=pokemon['spawnpoint_id'])
+
+    @staticmethod
+    def from_pokestop(fort):
+        lure_info = fort['lure_info']
+        return Pokemon(
+            lure_info['active_pokemon_id'],
+            (fort['latitude'], fort['longitude'], 0),
+            lure_info['lure_expires_timestamp_ms'],
+            from_lure=True,
+            pokestop_id=fort['id'])
+
+    @property
+    def name(self):
+        return Pokedata.names[self.pokemon_id]
+
+    @property
+    def rarity(self):
+        return Pokedata.rarities[self.pokemon_id]
+
+    @property
+    def disappear_time(self):
+        # only converted to a datetime once something needs it
+        if self._disappear_time is None and self.disappear_time_ms is not None:
+            self._disappear_time = datetime.utcfromtimestamp(self.disappear_time_ms / 1000.0)
+        return self._disappear_time
+
+    @disappear_time.setter
+    def disappear_time(self, value):
+        self._disappear_time = value
+        self.disappear_time_ms = _to_millis(value) if value else None
 
     def _get_key(self):
         if self.from_lure:
@@ -83,63 +115,64 @@ class Pokemon:
         min_remaining = int(self.expires_in().total_seconds() / 60)
         return '%s%ss' % ('%dm' % min_remaining if min_remaining > 0 else '', self.expires_in().seconds - 60 * min_remaining)
 
-    def get_distance(self):
-        position = Pokeconfig.get().position
-        distance = vincenty(position, self.position)
-        if Pokeconfig.get().distance_unit == 'meters':
-            return distance.meters
+    def get_distance(self, position=None, distance_unit=None):
+        """ Distance from position, the configured one by default, in
+        distance_unit. The last one computed is kept in meters.
+        """
+        config = Pokeconfig.get()
+        position = position or config.position
+        distance_unit = distance_unit or config.distance_unit
+        if self.distance is None or self.distance[0] != position:
+            from geopy.distance import vincenty
+            self.distance = (position, vincenty(position, self.position).meters)
+        if distance_unit == 'meters':
+            return self.distance[1]
         else:
-            return distance.miles
+            return self.distance[1] / METERS_PER_MILE
 
-    def get_distance_str(self):
-        if Pokeconfig.get().distance_unit == 'meters':
-            return '{:.0f} meters'.format(self.get_distance())    
+    def get_distance_str(self, position=None, distance_unit=None):
+        distance_unit = distance_unit or Pokeconfig.get().distance_unit
+        if distance_unit == 'meters':
+            return '{:.0f} meters'.format(self.get_distance(position, distance_unit))
         else:
-            return '{:.3f} miles'.format(self.get_distance())
+            return '{:.3f} miles'.format(self.get_distance(position, distance_unit))
 
     def __str__(self):
         return '%s<id:%s, key:%s, rarity: %s, expires_in: %s, distance: %s>' % (self.name, self.pokemon_id, self.key, self.rarity, self.expires_in_str(), self.get_distance_str())
 
 def parse_map(map_dict):
     pokemons = {}
-    pokestops = {}
+    for pokemon in iter_map(map_dict):
+        pokemons[pokemon.key] = pokemon
+    return pokemons
+
+def iter_map(map_dict, seen=()):
+    """ Lazily yields the pokemon in a GET_MAP_OBJECTS response, wild ones
+    first and then lured ones. Keys already in seen are skipped before any
+    Pokemon gets built.
+    """
+    found = set()
 
     cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
     for cell in cells:
         for p in cell.get('wild_pokemons', []):
-            pokemon = Pokemon.from_pokemon(p)
-            pokemons[pokemon.key] = pokemon
+            encounter_id = b64encode(str(p['encounter_id']))
+            if encounter_id in seen or encounter_id in found:
+                continue
+            found.add(encounter_id)
+            yield Pokemon.from_pokemon(p, encounter_id)
 
+    for cell in cells:
         for f in cell.get('forts', []):
-            if f.get('type') == 1:  # Pokestops
-                if 'lure_info' in f:
-                    lure_expiration = datetime.utcfromtimestamp(
-                        f['lure_info']['lure_expires_timestamp_ms'] / 1000.0)
-                    active_pokemon_id = f['lure_info']['active_pokemon_id']
-                    # logger.debug("at fort: %s, have active pokemon_id: %s", f['lure_info']['fort_id'], active_pokemon_id)
-                else:
-                    lure_expiration, active_pokemon_id = None, None
-
-                pokestops[f['id']] = {
-                    'pokestop_id': f['id'],
-                    'enabled': f['enabled'],
-                    'latitude': f['latitude'],
-                    'longitude': f['longitude'],
-                    'last_modified': datetime.utcfromtimestamp(
-                        f['last_modified_timestamp_ms'] / 1000.0),
-                    'lure_expiration': lure_expiration,
-                    'active_pokemon_id': active_pokemon_id
-                }
-    if pokestops:
-        for key in pokestops.keys():
-            pokestop = pokestops[key]
-            pokemon_id = pokestop['active_pokemon_id']
-            if pokemon_id:
-                pokemon = Pokemon.from_pokestop(pokestop)
-                if pokemon.pokemon_id and not pokemon.key in pokemons:
-                    pokemons[pokemon.key] = pokemon
-
-    return pokemons
+            # only lured pokestops with an active pokemon are interesting
+            lure_info = f.get('lure_info')
+            if not lure_info or f.get('type') != 1 or not lure_info.get('active_pokemon_id'):
+                continue
+            key = '%s_%s' % (f['id'], lure_info['active_pokemon_id'])
+            if key in seen or key in found:
+                continue
+            found.add(key)
+            yield Pokemon.from_pokestop(f)
 
 def json_deserializer(obj):
     for key, value in obj.items():
@@ -151,15 +184,17 @@ def json_deserializer(obj):
 def json_serializer(obj):
     try:
         if isinstance(obj, datetime):
-            if obj.utcoffset() is not None:
-                obj = obj - obj.utcoffset()
-            millis = int(
-                calendar.timegm(obj.timetuple()) * 1000 +
-                obj.microsecond / 1000
-            )
-            return millis
+            return _to_millis(obj)
         iterable = iter(obj)
     except TypeError:
         pass
     else:
         return list(iterable)
+
+def _to_millis(value):
+    if value.utcoffset() is not None:
+        value = value - value.utcoffset()
+    return int(
+        calendar.timegm(value.timetuple()) * 1000 +
+        value.microsecond / 1000
+    )
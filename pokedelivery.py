@@ -0,0 +1,195 @@
+# -*- coding: UTF-8 -*-
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from Queue import PriorityQueue, Empty
+
+from pokemetrics import Pokemetrics
+
+logger = logging.getLogger(__name__)
+
+SLACK_RATE_PER_SECOND = 1.0 # slack allows about one message per second per webhook
+SLACK_BURST = 5
+BATCH_WINDOW_SECONDS = 2 # alerts queued this close together go out as one message
+MAX_BATCH_SIZE = 20 # slack caps a message at 100 attachments, stay well below
+MAX_ATTEMPTS = 5
+RETRY_SLEEP = 2
+
+class Pokebucket:
+    """ Token bucket, take() blocks until a token is available. """
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+
+    def take(self):
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            self.sleep((1 - self.tokens) / self.rate)
+
+    def wait_time(self):
+        """ Seconds until take() would return, without taking a token. """
+        tokens = min(self.burst, self.tokens + (self.clock() - self.last) * self.rate)
+        return max(0, (1 - tokens) / self.rate)
+
+class Pokedelivery:
+    """ Posts alerts to a slack webhook from a background thread over one
+    pooled session. Alerts go out as soon as they are queued, but while
+    the rate limit holds a post back, alerts queued within
+    BATCH_WINDOW_SECONDS are coalesced into a single message with
+    attachments. Posts are rate limited by a token bucket. A failed post
+    is put back to go out again after a backoff, or after Retry-After when
+    slack answers 429, while other alerts keep going out, and is dropped
+    after MAX_ATTEMPTS. Alerts with a higher priority go out first and
+    come first within a message.
+    """
+    def __init__(self, slack_webhook_url, rate=SLACK_RATE_PER_SECOND, burst=SLACK_BURST, batch_window=BATCH_WINDOW_SECONDS):
+        self.slack_webhook_url = slack_webhook_url
+        self.session = None
+        self.bucket = Pokebucket(rate, burst)
+        self.batch_window = batch_window
+        self.queue = PriorityQueue()
+        self.order = itertools.count() # keeps alerts of the same priority in order
+        # alerts of failed posts as (not_before, order, entry), only the delivery thread touches them
+        self.retries = []
+        self.blocked_until = 0 # slack's Retry-After holds back every post to the webhook
+        self.thread = None
+
+    def start(self):
+        # requests takes a while to import, only pay for it once alerts can go out
+        import requests
+        self.session = requests.Session()
+        self.thread = threading.Thread(target=self._deliver_worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message, on_done=None, priority=0):
+        """ Queues a message, on_done(sent) is called once it was delivered
+        or given up on.
+        """
+        self.queue.put((-priority, next(self.order), message, on_done, 0))
+
+    def join(self):
+        self.queue.join()
+
+    def post(self, payload):
+        """ Posts one payload, returns (ok, retry_after_seconds). """
+        with Pokemetrics.timer('slack_post'):
+            r = self.session.post(self.slack_webhook_url, data=json.dumps(payload), timeout=10)
+        logger.info('slack post result: %s, %s', r.status_code, r.reason)
+        if r.status_code == 200:
+            return True, None
+        retry_after = None
+        if r.status_code == 429:
+            try:
+                retry_after = float(r.headers.get('Retry-After', RETRY_SLEEP))
+            except ValueError:
+                retry_after = RETRY_SLEEP
+        return False, retry_after
+
+    def _get(self, deadline=None):
+        # the next queued alert, with retries put back on the queue once
+        # they are due, raises Empty if there is none by deadline
+        while True:
+            now = time.time()
+            while self.retries and self.retries[0][0] <= now:
+                not_before, order, entry = heapq.heappop(self.retries)
+                # still the same unfinished alert as far as join() goes
+                self.queue.put(entry)
+                self.queue.task_done()
+            timeout = deadline - now if deadline is not None else None
+            if self.retries:
+                until_retry = self.retries[0][0] - now
+                timeout = until_retry if timeout is None else min(timeout, until_retry)
+            try:
+                if timeout is None:
+                    return self.queue.get()
+                return self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except Empty:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+    def _next_batch(self):
+        # waits for one message, then gathers whatever else is queued and,
+        # if the next post has to wait for the rate limit or a Retry-After
+        # anyway, whatever shows up until then, up to the batch window
+        batch = [self._get()]
+        now = time.time()
+        deadline = now + max(min(self.batch_window, self.bucket.wait_time()), self.blocked_until - now)
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(self._get(deadline))
+            except Empty:
+                break
+        batch.sort()
+        return batch
+
+    def _deliver_worker(self):
+        while True:
+            batch = self._next_batch()
+            blocked = self.blocked_until - time.time()
+            if blocked > 0:
+                time.sleep(blocked)
+            self.bucket.take()
+            try:
+                sent, retry_after = self.post(make_payload([entry[2] for entry in batch]))
+            except:
+                logger.warn('exception happened on slack post', exc_info=True)
+                sent, retry_after = False, None
+            if sent:
+                for entry in batch:
+                    self._done(entry, True)
+                continue
+            if retry_after is not None:
+                self.blocked_until = time.time() + retry_after
+            # failed alerts wait on the side, the next batch goes out meanwhile
+            dropped = 0
+            for entry in batch:
+                attempts = entry[4] + 1
+                if attempts >= MAX_ATTEMPTS:
+                    dropped += 1
+                    self._done(entry, False)
+                else:
+                    timeout = retry_after if retry_after is not None else RETRY_SLEEP * attempts
+                    heapq.heappush(self.retries, (time.time() + timeout, entry[1], entry[:4] + (attempts,)))
+            if dropped < len(batch):
+                Pokemetrics.inc('retries', 'slack_post')
+                logger.warn('slack post of %s alerts failed, retrying %s of them', len(batch), len(batch) - dropped)
+            if dropped:
+                logger.error('giving up on %s alerts after %s attempts', dropped, MAX_ATTEMPTS)
+                Pokemetrics.inc('alerts_dropped', 'delivery', dropped)
+
+    def _done(self, entry, sent):
+        on_done = entry[3]
+        if on_done:
+            on_done(sent)
+        self.queue.task_done()
+
+def make_payload(messages):
+    payload = {
+        'username': 'Poké Alert!',
+        'icon_emoji': ':ghost:'
+    }
+    if len(messages) == 1:
+        payload['text'] = messages[0]
+    else:
+        payload['text'] = 'I found %s pokemon' % len(messages)
+        payload['attachments'] = [{
+            'fallback': message,
+            'text': message,
+            'mrkdwn_in': ['text']
+        } for message in messages]
+    return payload
@@ -0,0 +1,86 @@
+import logging
+import time
+
+from pokeconfig import Pokeconfig
+from pokemetrics import Pokemetrics
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_METERS = 6371008.8
+WALK_PADDING = 1.1 # pad walking distances by 10%
+HAVERSINE_ERROR = 0.005 # haversine is within 0.5% of vincenty
+# alert scores: each star of rarity is worth RARITY_POINTS, every minute to
+# spare after walking there costs a point and so does every DISTANCE_METERS_PER_POINT
+RARITY_POINTS = 10
+DISTANCE_METERS_PER_POINT = 500
+
+def get_distances_meters(position, latitudes, longitudes):
+    """ Haversine distances in meters from position to each lat/lng. """
+    import numpy as np
+    lat1 = np.radians(position[0])
+    lng1 = np.radians(position[1])
+    lat2 = np.radians(latitudes)
+    lng2 = np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+def filter_sendable(pokemons, position, rarity_limit, now=None):
+    """ Computes every pokemon's distance from position in one pass,
+    stores it on the pokemons that don't have it yet, and returns the ones
+    that don't expire too soon, are rare enough and can be walked to in time.
+    Pokemon too close to the walking cutoff for haversine to tell are
+    decided with vincenty, like Pokeslack.should_send does.
+    """
+    if len(pokemons) == 0:
+        return []
+    import numpy as np
+    meters, rarities, expires_in, travel_time = _get_walks(pokemons, position, now)
+    not_expired = expires_in >= Pokeconfig.EXPIRE_BUFFER_SECONDS
+    rare = rarities >= rarity_limit
+    reachable = expires_in >= travel_time
+    close_call = not_expired & rare & (np.abs(expires_in - travel_time) <= travel_time * HAVERSINE_ERROR)
+    if close_call.any():
+        from geopy.distance import vincenty
+        for i in np.flatnonzero(close_call).tolist():
+            meters[i] = vincenty(position, pokemons[i].position).meters
+            reachable[i] = expires_in[i] >= meters[i] * WALK_PADDING / Pokeconfig.WALK_METERS_PER_SECOND
+    sendable = not_expired & rare & reachable
+    if Pokemetrics.enabled:
+        Pokemetrics.inc('alerts_skipped', 'expiry', int(np.count_nonzero(~not_expired)))
+        Pokemetrics.inc('alerts_skipped', 'rarity', int(np.count_nonzero(not_expired & ~rare)))
+        Pokemetrics.inc('alerts_skipped', 'distance', int(np.count_nonzero(not_expired & rare & ~reachable)))
+
+    for pokemon, distance in zip(pokemons, meters.tolist()):
+        if pokemon.distance is None or pokemon.distance[0] != position:
+            pokemon.distance = (position, distance)
+    return [pokemon for pokemon, ok in zip(pokemons, sendable.tolist()) if ok]
+
+def score_sendable(pokemons, position, now=None):
+    """ Scores pokemon for sending, rarer, closer and more urgent pokemon
+    score higher. Returns a list of (score, deadline) where deadline is the
+    last time a pokemon can be sent and still be walked to in time.
+    """
+    if len(pokemons) == 0:
+        return []
+    import numpy as np
+    now = now or time.time()
+    meters, rarities, expires_in, travel_time = _get_walks(pokemons, position, now)
+    spare_time = expires_in - travel_time
+    scores = rarities * RARITY_POINTS - spare_time / 60 - meters / DISTANCE_METERS_PER_POINT
+    deadlines = now + np.minimum(spare_time, expires_in - Pokeconfig.EXPIRE_BUFFER_SECONDS)
+    return zip(scores.tolist(), deadlines.tolist())
+
+def _get_walks(pokemons, position, now):
+    # distances, rarities, seconds until expiry and seconds to walk there,
+    # numpy is imported on the first batch rather than at startup
+    import numpy as np
+    num_pokemons = len(pokemons)
+    now_ms = (now or time.time()) * 1000
+    latitudes = np.fromiter((pokemon.position[0] for pokemon in pokemons), float, num_pokemons)
+    longitudes = np.fromiter((pokemon.position[1] for pokemon in pokemons), float, num_pokemons)
+    rarities = np.fromiter((pokemon.rarity for pokemon in pokemons), int, num_pokemons)
+    expires_in = (np.fromiter((pokemon.disappear_time_ms for pokemon in pokemons), float, num_pokemons) - now_ms) / 1000
+
+    meters = get_distances_meters(position, latitudes, longitudes)
+    travel_time = meters * WALK_PADDING / Pokeconfig.WALK_METERS_PER_SECOND
+    return meters, rarities, expires_in, travel_time
@@ -0,0 +1,183 @@
+import heapq
+import json
+import logging
+import math
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+from pokefilter import EARTH_RADIUS_METERS, get_distances_meters
+from pokemetrics import Pokemetrics
+
+logger = logging.getLogger(__name__)
+
+GRID_METERS = 100 # side of a grid bucket, about a scan step across
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180
+DEFAULT_RADIUS_METERS = 1000
+MAX_RADIUS_METERS = 20000
+
+class Pokeindex:
+    """ The live pokemon, bucketed in a lat/lng grid of about GRID_METERS
+    squares around position, for looking up what is within some distance of
+    a point. Pokemon drop out of the index when they disappear.
+    """
+    def __init__(self, position, grid_meters=GRID_METERS):
+        self.lock = threading.Lock()
+        self.position = position
+        self.lat_size = float(grid_meters) / METERS_PER_DEGREE
+        self.lng_size = self.lat_size / max(math.cos(math.radians(position[0])), 0.01)
+        self.cells = {}
+        self.pokemons = {} # key -> (pokemon, cell)
+        self.queue = []
+
+    def __len__(self):
+        return len(self.pokemons)
+
+    def add(self, pokemon, now=None):
+        if pokemon.disappear_time_ms is None:
+            return
+        cell = self._get_cell(pokemon.position[0], pokemon.position[1])
+        with self.lock:
+            self._evict(now)
+            self._remove(pokemon.key)
+            self.pokemons[pokemon.key] = (pokemon, cell)
+            # what a query needs, looked up once instead of on every query
+            self.cells.setdefault(cell, {})[pokemon.key] = (pokemon.rarity, pokemon.disappear_time_ms,
+                pokemon.position[0], pokemon.position[1], pokemon)
+            heapq.heappush(self.queue, (pokemon.disappear_time_ms, pokemon.key))
+
+    def get_live(self, now=None):
+        with self.lock:
+            self._evict(now)
+            return [pokemon for pokemon, cell in self.pokemons.itervalues()]
+
+    def query(self, lat, lng, radius_meters, min_rarity=0, now=None):
+        """ The pokemon within radius_meters of lat, lng with at least
+        min_rarity, as a list of (meters, pokemon), closest first.
+        """
+        lat_delta = radius_meters / METERS_PER_DEGREE
+        # the cells get narrower towards the poles, widen the box for the
+        # latitude of its edge closest to them
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_delta, 89.9)))
+        lng_delta = lat_delta / max(cos_lat, 0.001)
+        min_i, min_j = self._get_cell(lat - lat_delta, lng - lng_delta)
+        max_i, max_j = self._get_cell(lat + lat_delta, lng + lng_delta)
+        candidates = []
+        with self.lock:
+            self._evict(now)
+            now_ms = (now or time.time()) * 1000
+            cells = self.cells
+            for i in xrange(min_i, max_i + 1):
+                for j in xrange(min_j, max_j + 1):
+                    pokemons = cells.get((i, j))
+                    if not pokemons:
+                        continue
+                    for entry in pokemons.itervalues():
+                        if entry[0] >= min_rarity and entry[1] > now_ms:
+                            candidates.append(entry)
+        if not candidates:
+            return []
+        # the distances to everything in the box in one go
+        import numpy as np
+        num_candidates = len(candidates)
+        meters = get_distances_meters((lat, lng),
+            np.fromiter((entry[2] for entry in candidates), float, num_candidates),
+            np.fromiter((entry[3] for entry in candidates), float, num_candidates))
+        found = [(distance, entry[4]) for distance, entry in zip(meters.tolist(), candidates) if distance <= radius_meters]
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serves read only queries of the index on
+        http://host:port/pokemon?lat=&lng=&radius=&rarity= from background
+        threads.
+        """
+        server = _Server((host, port), _IndexHandler)
+        server.pokeindex = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('serving live pokemon on port %s', port)
+        return server
+
+    def _get_cell(self, lat, lng):
+        return int(math.floor(lat / self.lat_size)), int(math.floor(lng / self.lng_size))
+
+    def _remove(self, key):
+        entry = self.pokemons.pop(key, None)
+        if entry:
+            pokemon, cell = entry
+            pokemons = self.cells[cell]
+            del pokemons[key]
+            if not pokemons:
+                del self.cells[cell]
+
+    def _evict(self, now=None):
+        now_ms = (now or time.time()) * 1000
+        while self.queue and self.queue[0][0] <= now_ms:
+            disappear_time_ms, key = heapq.heappop(self.queue)
+            # only drop the pokemon if this is its latest entry
+            entry = self.pokemons.get(key)
+            if entry and entry[0].disappear_time_ms == disappear_time_ms:
+                self._remove(key)
+
+def to_json(meters, pokemon):
+    return {
+        'key': pokemon.key,
+        'pokemon_id': pokemon.pokemon_id,
+        'name': pokemon.name,
+        'rarity': pokemon.rarity,
+        'latitude': pokemon.position[0],
+        'longitude': pokemon.position[1],
+        'disappear_time': pokemon.disappear_time_ms,
+        'from_lure': pokemon.from_lure,
+        'distance': int(round(meters))
+    }
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _IndexHandler(BaseHTTPRequestHandler):
+    # keep connections open, clients polling a map shouldn't reconnect every time
+    protocol_version = 'HTTP/1.1'
+    # the headers and body go out in separate writes, don't hold the body
+    # back waiting for the client to ack the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/pokemon':
+            self._send(404, {'error': 'not found'})
+            return
+        pokeindex = self.server.pokeindex
+        params = parse_qs(url.query)
+        try:
+            lat = float(params.get('lat', [pokeindex.position[0]])[0])
+            lng = float(params.get('lng', [pokeindex.position[1]])[0])
+            radius = float(params.get('radius', [DEFAULT_RADIUS_METERS])[0])
+            rarity = int(params.get('rarity', [0])[0])
+        except ValueError:
+            self._send(400, {'error': 'lat, lng and radius must be numbers and rarity an integer'})
+            return
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 0 <= radius <= MAX_RADIUS_METERS):
+            self._send(400, {'error': 'lat, lng or radius out of range, radius is at most %s meters' % MAX_RADIUS_METERS})
+            return
+        with Pokemetrics.timer('api_query'):
+            found = pokeindex.query(lat, lng, radius, rarity)
+        self._send(200, {'pokemon': [to_json(meters, pokemon) for meters, pokemon in found]})
+
+    def _send(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        # read only, so any page may query it
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,166 @@
+import bisect
+import logging
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = 'pokeslack_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Pokemetrics:
+    """ Latency histograms, counters and gauges for the hot path, served in
+    the prometheus text format. Everything is a no-op until enabled.
+    """
+    enabled = False
+    lock = threading.Lock()
+    histograms = {}
+    counters = {}
+    gauges = {}
+
+    @staticmethod
+    def observe(name, seconds):
+        if not Pokemetrics.enabled:
+            return
+        with Pokemetrics.lock:
+            histogram = Pokemetrics.histograms.get(name)
+            if histogram is None:
+                histogram = Pokemetrics.histograms[name] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @staticmethod
+    def inc(name, reason=None, value=1):
+        if not Pokemetrics.enabled:
+            return
+        with Pokemetrics.lock:
+            key = (name, reason)
+            Pokemetrics.counters[key] = Pokemetrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def set(name, value):
+        if not Pokemetrics.enabled:
+            return
+        with Pokemetrics.lock:
+            Pokemetrics.gauges[name] = value
+
+    @staticmethod
+    def timer(name):
+        if not Pokemetrics.enabled:
+            return _NULL_TIMER
+        return _Timer(name)
+
+    @staticmethod
+    def take():
+        """ Returns what was recorded since the last take and starts over,
+        for passing the metrics of a worker process on to merge.
+        """
+        with Pokemetrics.lock:
+            taken = (Pokemetrics.histograms, Pokemetrics.counters, Pokemetrics.gauges)
+            Pokemetrics.histograms = {}
+            Pokemetrics.counters = {}
+            Pokemetrics.gauges = {}
+        return taken
+
+    @staticmethod
+    def merge(taken):
+        """ Adds the histograms and counters from take to these, the gauges
+        are set to the taken values.
+        """
+        if not Pokemetrics.enabled or not taken:
+            return
+        histograms, counters, gauges = taken
+        with Pokemetrics.lock:
+            for name, (buckets, total, count) in histograms.items():
+                histogram = Pokemetrics.histograms.get(name)
+                if histogram is None:
+                    histogram = Pokemetrics.histograms[name] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+            for key, value in counters.items():
+                Pokemetrics.counters[key] = Pokemetrics.counters.get(key, 0) + value
+            Pokemetrics.gauges.update(gauges)
+
+    @staticmethod
+    def render():
+        lines = []
+        with Pokemetrics.lock:
+            for name in sorted(Pokemetrics.histograms):
+                buckets, total, count = Pokemetrics.histograms[name]
+                metric = '%s%s_seconds' % (METRICS_PREFIX, name)
+                lines.append('# TYPE %s histogram' % metric)
+                cumulative = 0
+                for le, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append('%s_bucket{le="%s"} %s' % (metric, le, cumulative))
+                lines.append('%s_sum %s' % (metric, total))
+                lines.append('%s_count %s' % (metric, count))
+            typed = set()
+            for name, reason in sorted(Pokemetrics.counters, key=lambda key: (key[0], key[1] or '')):
+                metric = '%s%s_total' % (METRICS_PREFIX, name)
+                if not metric in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE %s counter' % metric)
+                value = Pokemetrics.counters[(name, reason)]
+                if reason:
+                    lines.append('%s{reason="%s"} %s' % (metric, reason, value))
+                else:
+                    lines.append('%s %s' % (metric, value))
+            for name in sorted(Pokemetrics.gauges):
+                metric = '%s%s' % (METRICS_PREFIX, name)
+                lines.append('# TYPE %s gauge' % metric)
+                lines.append('%s %s' % (metric, Pokemetrics.gauges[name]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def serve(port, host='127.0.0.1'):
+        """ Enables the metrics and serves them on http://host:port/metrics
+        from a background thread.
+        """
+        Pokemetrics.enabled = True
+        server = HTTPServer((host, port), _MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info('serving metrics on port %s', port)
+        return server
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        Pokemetrics.observe(self.name, time.time() - self.start)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = Pokemetrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
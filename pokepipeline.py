@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from Queue import Queue, Empty
+
+from pokemetrics import Pokemetrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 100
+
+class Pokepipeline:
+    """ Runs filtering and slack delivery on their own threads, connected by
+    bounded queues, so a slow webhook doesn't stall the scan and a slow scan
+    doesn't hold back alerts. A full queue blocks the stage feeding it.
+    Alerts are scored and the best ones are sent first, unless prioritize
+    is off and they go out in the order they were found. Pokemon taken in
+    are added to seen, and discarded from it again when their alert is
+    dropped, so the next scan brings them back.
+    """
+    def __init__(self, pokeslacks, queue_size=QUEUE_SIZE, prioritize=True, seen=None):
+        # one Pokeslack per region, every pokemon found goes through each of them
+        self.pokeslacks = pokeslacks
+        self.prioritize = prioritize
+        self.seen = seen
+        self.found_queue = Queue(maxsize=queue_size)
+        self.send_queue = Pokepriority(maxsize=queue_size, on_drop=self._dropped)
+
+    def start(self):
+        for target in (self._filter_worker, self._send_worker):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def put(self, pokemon):
+        # marked seen before the workers can see it, so a drop always comes after
+        if self.seen is not None:
+            self.seen.add_pokemon(pokemon)
+        self.found_queue.put(pokemon)
+
+    def join(self):
+        self.found_queue.join()
+        self.send_queue.join()
+
+    def _filter_worker(self):
+        while True:
+            # filter whatever has piled up in one batch
+            pokemons = [self.found_queue.get()]
+            while True:
+                try:
+                    pokemons.append(self.found_queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                for pokeslack in self.pokeslacks:
+                    sendable = pokeslack.filter_sendable(pokemons)
+                    for pokemon, (score, deadline) in zip(sendable, pokeslack.score_sendable(sendable)):
+                        self.send_queue.put(pokeslack, pokemon, score if self.prioritize else 0, deadline)
+            except:
+                logger.warn('exception happened filtering pokemon', exc_info=True)
+                for pokemon in pokemons:
+                    self._dropped(pokemon)
+            finally:
+                for pokemon in pokemons:
+                    self.found_queue.task_done()
+
+    def _send_worker(self):
+        while True:
+            pokeslack, pokemon, score = self.send_queue.get()
+            try:
+                pokeslack.send_pokemon(pokemon, score, self._dropped)
+            except:
+                logger.warn('exception happened sending pokemon', exc_info=True)
+                self._dropped(pokemon)
+            finally:
+                self.send_queue.task_done()
+
+    def _dropped(self, pokemon):
+        if self.seen is not None:
+            self.seen.discard(pokemon.key)
+
+class Pokepriority:
+    """ Alerts waiting to be sent, handed out highest score first. Alerts
+    that can't be walked to in time anymore are dropped as soon as they are
+    looked at, on the way out and whenever the queue fills up. Has the
+    task_done() and join() of a Queue. on_drop is called with every pokemon
+    dropped.
+    """
+    def __init__(self, maxsize=QUEUE_SIZE, clock=time.time, on_drop=None):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.on_drop = on_drop
+        self.cond = threading.Condition()
+        self.heap = []
+        self.order = itertools.count() # keeps alerts of the same score in order
+        self.unfinished = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, pokeslack, pokemon, score, deadline):
+        with self.cond:
+            if len(self.heap) >= self.maxsize:
+                self._evict()
+            while len(self.heap) >= self.maxsize:
+                self.cond.wait()
+                self._evict()
+            heapq.heappush(self.heap, (-score, next(self.order), deadline, pokeslack, pokemon))
+            self.unfinished += 1
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while True:
+                while not self.heap:
+                    self.cond.wait()
+                neg_score, order, deadline, pokeslack, pokemon = heapq.heappop(self.heap)
+                self.cond.notify_all()
+                if deadline >= self.clock():
+                    return pokeslack, pokemon, -neg_score
+                self._drop(pokemon)
+
+    def task_done(self):
+        with self.cond:
+            self._done()
+
+    def join(self):
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+
+    def _evict(self):
+        now = self.clock()
+        reachable = [entry for entry in self.heap if entry[2] >= now]
+        for entry in self.heap:
+            if entry[2] < now:
+                self._drop(entry[4])
+        self.heap = reachable
+        heapq.heapify(self.heap)
+
+    def _drop(self, pokemon):
+        logger.info('dropping alert that can no longer be reached in time')
+        Pokemetrics.inc('alerts_skipped', 'unreachable')
+        if self.on_drop:
+            self.on_drop(pokemon)
+        self._done()
+
+    def _done(self):
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.cond.notify_all()
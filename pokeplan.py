@@ -0,0 +1,337 @@
+import json
+import logging
+import math
+import os
+
+from pokefilter import EARTH_RADIUS_METERS, get_distances_meters
+
+logger = logging.getLogger(__name__)
+
+CELL_LEVEL = 15
+PLAN_CACHE_FILENAME = 'scan_plans.json'
+COVER_TOLERANCE = 0.02 # neighbouring hex steps only just cover each other, allow for that
+
+# scan plans by (lat, lng, num_steps, visible_range_meters), and the joined
+# plans of several regions, the scan plans can be saved to disk
+_plans = {}
+_region_plans = {}
+_unsaved = False
+
+def plan_scan(position, num_steps, visible_range_meters):
+    """ Returns the list of (coord, cell_ids) requests for a scan.
+    Pokemon are only visible within visible_range_meters of the request
+    position, so the hex steps stay as they are, but each request only asks
+    for the level 15 cells its visible range actually touches instead of
+    walking 10 cells either way along the hilbert curve.
+    """
+    global _unsaved
+    key = (position[0], position[1], num_steps, float(visible_range_meters))
+    if not key in _plans:
+        plan = []
+        for coord in get_location_steps(position, num_steps, visible_range_meters):
+            plan.append((coord, get_visible_cell_ids(coord[0], coord[1], visible_range_meters)))
+        _plans[key] = plan
+        _unsaved = True
+        logger.info('planned scan with %s requests covering %s cells', len(plan), len(get_plan_cell_ids(plan)))
+    return _plans[key]
+
+def plan_regions(regions, visible_range_meters):
+    """ Joins the scan plans of several regions into one. A step whose whole
+    visible circle is already seen by the steps planned for earlier regions
+    is dropped.
+    """
+    key = (tuple((region.position[0], region.position[1], region.num_steps) for region in regions), visible_range_meters)
+    if not key in _region_plans:
+        import numpy as np
+        circle = get_circle_points()
+        plan = []
+        for region in regions:
+            region_plan = plan_scan(region.position, region.num_steps, visible_range_meters)
+            planned = np.array([(coord[0], coord[1]) for coord, cell_ids in plan], dtype=float)
+            for coord, cell_ids in region_plan:
+                if not len(planned) or not is_covered(coord, planned, visible_range_meters, circle):
+                    plan.append((coord, cell_ids))
+        _region_plans[key] = plan
+        num_steps = sum(len(plan_scan(region.position, region.num_steps, visible_range_meters)) for region in regions)
+        logger.info('planned %s regions with %s requests, %s saved by overlap', len(regions), len(plan), num_steps - len(plan))
+    return _region_plans[key]
+
+def get_circle_points(num_rings=8):
+    """ Points spread over the unit disc, on num_rings rings around its
+    center and at most 1 / num_rings apart along each ring.
+    """
+    import numpy as np
+    points = [(0.0, 0.0)]
+    for ring in xrange(1, num_rings + 1):
+        num_points = int(math.ceil(2 * math.pi * ring))
+        angles = np.arange(num_points) * (2 * math.pi / num_points)
+        points.extend(zip((np.cos(angles) * ring / num_rings).tolist(), (np.sin(angles) * ring / num_rings).tolist()))
+    return np.array(points)
+
+def is_covered(coord, steps, visible_range_meters, circle=None):
+    """ Whether everything within visible_range_meters of coord is also
+    within it of one of the (lat, lng) steps, checked at the circle points.
+    """
+    import numpy as np
+    if circle is None:
+        circle = get_circle_points()
+    steps = steps[get_distances_meters(coord, steps[:, 0], steps[:, 1]) < 2 * visible_range_meters]
+    if not len(steps):
+        return False
+    # the circle points around coord, as (lat, lng) columns
+    degrees = np.degrees(circle * (visible_range_meters / EARTH_RADIUS_METERS))
+    latitudes = coord[0] + degrees[:, 1, np.newaxis]
+    longitudes = coord[1] + degrees[:, 0, np.newaxis] / math.cos(math.radians(coord[0]))
+    meters = get_distances_meters((latitudes, longitudes), steps[:, 0], steps[:, 1])
+    return bool((meters.min(axis=1) <= visible_range_meters * (1 + COVER_TOLERANCE)).all())
+
+def load_plans(filename=PLAN_CACHE_FILENAME):
+    if not filename or not os.path.exists(filename):
+        return
+    try:
+        with open(filename, 'r') as fp:
+            saved = json.load(fp)
+    except ValueError:
+        logger.warn('ignoring broken plan cache %s', filename)
+        return
+    for entry in saved:
+        key = (entry['latitude'], entry['longitude'], entry['num_steps'], entry['visible_range_meters'])
+        _plans[key] = [((lat, lng, 0), cell_ids) for lat, lng, cell_ids in entry['steps']]
+    logger.info('loaded %s scan plans from %s', len(saved), filename)
+
+def save_plans(filename=PLAN_CACHE_FILENAME):
+    """ Writes the scan plans to filename if any were added since the last
+    load or save.
+    """
+    global _unsaved
+    if not filename or not _unsaved:
+        return
+    saved = [{
+        'latitude': key[0],
+        'longitude': key[1],
+        'num_steps': key[2],
+        'visible_range_meters': key[3],
+        'steps': [(coord[0], coord[1], cell_ids) for coord, cell_ids in plan]
+    } for key, plan in _plans.items()]
+    with open(filename, 'w') as fp:
+        json.dump(saved, fp)
+    _unsaved = False
+
+LATE_SECONDS = 300 # pokemon seen with less than this left were reached late
+LURE_HEAT = 3 # lures keep drawing in new pokemon for 30 minutes
+
+def get_heat(pokemon, now):
+    """ How much a sighting should pull its step forward in the next scan:
+    rare pokemon count the most, more so when they were nearly gone by the
+    time the scan got there or came from a lure.
+    """
+    heat = pokemon.rarity ** 2
+    if pokemon.disappear_time_ms / 1000.0 - now < LATE_SECONDS:
+        heat *= 2
+    if pokemon.from_lure:
+        heat *= LURE_HEAT
+    return heat
+
+def order_by_heat(plan, hot_spots, visible_range_meters, max_hot_steps=None):
+    """ Reorders plan to visit the steps around the hottest (lat, lng, heat)
+    hot_spots first and again halfway through, since they are the likeliest
+    to have something worth sending. The hot steps are capped at a tenth of
+    the plan, the rest keep their nearest first spiral order.
+    """
+    if not hot_spots or not plan:
+        return plan
+    import numpy as np
+    spots = np.array(hot_spots, dtype=float)
+    steps = np.array([(coord[0], coord[1]) for coord, cell_ids in plan], dtype=float)
+    # distances from every hot spot, a row each, to every step
+    meters = get_distances_meters((spots[:, 0, np.newaxis], spots[:, 1, np.newaxis]), steps[:, 0], steps[:, 1])
+    # a spot heats up every step that sees it, or the closest one
+    seen = (meters <= visible_range_meters) | (meters == meters.min(axis=1)[:, np.newaxis])
+    heat = (seen * spots[:, 2, np.newaxis]).sum(axis=0).tolist()
+
+    max_hot_steps = max_hot_steps or max(1, len(plan) / 10)
+    hot = sorted((i for i in xrange(len(plan)) if heat[i] > 0), key=lambda i: -heat[i])[:max_hot_steps]
+    hot_set = set(hot)
+    rest = [i for i in xrange(len(plan)) if not i in hot_set]
+    half = len(rest) / 2
+    logger.info('scanning %s hot steps first and again halfway through', len(hot))
+    return [plan[i] for i in hot + rest[:half] + hot + rest[half:]]
+
+def get_sector(position, coord, num_sectors):
+    """ Which of num_sectors equal pie slices around position coord is in,
+    the hex spiral puts about as many steps in each.
+    """
+    x, y = get_approx_offset(position, coord)
+    bearing = math.atan2(x, y) % (2 * math.pi)
+    return min(num_sectors - 1, int(bearing / (2 * math.pi) * num_sectors))
+
+def get_approx_offset(a, b):
+    # (east, north) meters from a to b, the equirectangular approximation is
+    # plenty for a few kilometers
+    x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    y = math.radians(b[0] - a[0])
+    return x * EARTH_RADIUS_METERS, y * EARTH_RADIUS_METERS
+
+def get_approx_meters(a, b):
+    return math.hypot(*get_approx_offset(a, b))
+
+def get_plan_cell_ids(plan):
+    cell_ids = set()
+    for coord, step_cell_ids in plan:
+        cell_ids.update(step_cell_ids)
+    return cell_ids
+
+def compare_plans(position, num_steps, visible_range_meters):
+    """ Counts requests and cells for the fixed hex spiral with hilbert walks
+    against the planned scan.
+    """
+    hex_cell_ids = []
+    for coord in generate_location_steps(position, num_steps, visible_range_meters):
+        hex_cell_ids.append(get_cell_ids(coord[0], coord[1]))
+    plan = plan_scan(position, num_steps, visible_range_meters)
+    plan_cell_ids = get_plan_cell_ids(plan)
+
+    hex_requested = sum(len(cell_ids) for cell_ids in hex_cell_ids)
+    hex_unique = set()
+    for cell_ids in hex_cell_ids:
+        hex_unique.update(cell_ids)
+    plan_requested = sum(len(cell_ids) for coord, cell_ids in plan)
+
+    return {
+        'hex_requests': len(hex_cell_ids),
+        'hex_cells_requested': hex_requested,
+        'hex_redundant_cells': hex_requested - len(hex_unique),
+        'hex_cells_outside_area': len(hex_unique - plan_cell_ids),
+        'plan_requests': len(plan),
+        'plan_cells_requested': plan_requested,
+        'plan_redundant_cells': plan_requested - len(plan_cell_ids),
+        'area_cells': len(plan_cell_ids)
+    }
+
+def get_visible_cell_ids(lat, lng, radius_meters):
+    # s2sphere is only needed for plans that aren't cached yet
+    from s2sphere import Angle, Cap, LatLng, RegionCoverer
+    axis = LatLng.from_degrees(lat, lng).to_point()
+    cap = Cap.from_axis_angle(axis, Angle.from_degrees(math.degrees(radius_meters / EARTH_RADIUS_METERS)))
+    coverer = RegionCoverer()
+    coverer.min_level = CELL_LEVEL
+    coverer.max_level = CELL_LEVEL
+    coverer.max_cells = 100
+    return sorted(cell_id.id() for cell_id in coverer.get_covering(cap))
+
+# hex moves as (east, north) multiples of the column and row distances, in the
+# order generate_location_steps walks a ring: right, down right, down left,
+# left, up left, up right
+HEX_MOVES = ((1, 0), (0.5, -1), (-0.5, -1), (-1, 0), (-0.5, 1), (0.5, 1))
+
+def get_location_steps(position, num_steps, visible_range_meters):
+    """ The same spiral as generate_location_steps, computed in one pass:
+    every step's offset from position is summed up on a flat hex grid and
+    all of them are projected onto the sphere at once.
+    """
+    import numpy as np
+    pulse_radius = visible_range_meters / 1000.0
+    xdist = math.sqrt(3) * pulse_radius
+    ydist = 3 * (pulse_radius / 2)
+
+    offsets = [np.zeros((1, 2))]
+    for ring in xrange(1, num_steps):
+        moves = np.repeat(np.array(HEX_MOVES), ring, axis=0)
+        offsets.append(np.cumsum(moves, axis=0) + (-0.5 * ring, ring))
+    offsets = np.concatenate(offsets) * (xdist, ydist)
+
+    distances = np.hypot(offsets[:, 0], offsets[:, 1]) * 1000 / EARTH_RADIUS_METERS
+    bearings = np.arctan2(offsets[:, 0], offsets[:, 1])
+    lat1 = math.radians(position[0])
+    lng1 = math.radians(position[1])
+    lats = np.arcsin(math.sin(lat1) * np.cos(distances) + math.cos(lat1) * np.sin(distances) * np.cos(bearings))
+    lngs = lng1 + np.arctan2(np.sin(bearings) * np.sin(distances) * math.cos(lat1), np.cos(distances) - math.sin(lat1) * np.sin(lats))
+    return [(lat, lng, 0) for lat, lng in zip(np.degrees(lats).tolist(), np.degrees(lngs).tolist())]
+
+def generate_location_steps(position, num_steps, visible_range_meters):
+    #Bearing (degrees)
+    NORTH = 0
+    EAST = 90
+    SOUTH = 180
+    WEST = 270
+
+    pulse_radius = visible_range_meters / 1000.0 # km - radius of players heartbeat is 100m
+    xdist = math.sqrt(3)*pulse_radius   # dist between column centers
+    ydist = 3*(pulse_radius/2)          # dist between row centers
+
+    yield (position[0], position[1], 0) #insert initial location
+
+    ring = 1
+    loc = position
+    while ring < num_steps:
+        #Set loc to start at top left
+        loc = get_new_coords(loc, ydist, NORTH)
+        loc = get_new_coords(loc, xdist/2, WEST)
+        for direction in range(6):
+            for i in range(ring):
+                if direction == 0: # RIGHT
+                    loc = get_new_coords(loc, xdist, EAST)
+                if direction == 1: # DOWN + RIGHT
+                    loc = get_new_coords(loc, ydist, SOUTH)
+                    loc = get_new_coords(loc, xdist/2, EAST)
+                if direction == 2: # DOWN + LEFT
+                    loc = get_new_coords(loc, ydist, SOUTH)
+                    loc = get_new_coords(loc, xdist/2, WEST)
+                if direction == 3: # LEFT
+                    loc = get_new_coords(loc, xdist, WEST)
+                if direction == 4: # UP + LEFT
+                    loc = get_new_coords(loc, ydist, NORTH)
+                    loc = get_new_coords(loc, xdist/2, WEST)
+                if direction == 5: # UP + RIGHT
+                    loc = get_new_coords(loc, ydist, NORTH)
+                    loc = get_new_coords(loc, xdist/2, EAST)
+                yield (loc[0], loc[1], 0)
+        ring += 1
+
+def get_new_coords(init_loc, distance, bearing):
+    """ Given an initial lat/lng, a distance(in kms), and a bearing (degrees),
+    this will calculate the resulting lat/lng coordinates.
+    """
+    R = EARTH_RADIUS_METERS / 1000 #km radius of the earth
+    bearing = math.radians(bearing)
+
+    init_coords = [math.radians(init_loc[0]), math.radians(init_loc[1])] # convert lat/lng to radians
+
+    new_lat = math.asin( math.sin(init_coords[0])*math.cos(distance/R) +
+        math.cos(init_coords[0])*math.sin(distance/R)*math.cos(bearing))
+
+    new_lon = init_coords[1] + math.atan2(math.sin(bearing)*math.sin(distance/R)*math.cos(init_coords[0]),
+        math.cos(distance/R)-math.sin(init_coords[0])*math.sin(new_lat))
+
+    return [math.degrees(new_lat), math.degrees(new_lon)]
+
+def get_cell_ids(lat, lng, radius = 10):
+    from s2sphere import CellId, LatLng
+    origin = CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).parent(15)
+    walk = [origin.id()]
+    right = origin.next()
+    left = origin.prev()
+
+    # Search around provided radius
+    for i in range(radius):
+        walk.append(right.id())
+        walk.append(left.id())
+        right = right.next()
+        left = left.prev()
+
+    # Return everything
+    return sorted(walk)
+
+if __name__ == '__main__':
+    # report what the planner saves over the hex spiral, e.g.
+    # python pokeplan.py 37.7749 -122.4194 70
+    import sys
+    position = (float(sys.argv[1]), float(sys.argv[2]), 0) if len(sys.argv) > 2 else (37.7749, -122.4194, 0)
+    visible_range_meters = float(sys.argv[3]) if len(sys.argv) > 3 else 70
+    for num_steps in range(1, 11):
+        stats = compare_plans(position, num_steps, visible_range_meters)
+        print('num_steps=%2d requests=%3d hex_cells=%4d (%4d redundant, %3d outside) plan_cells=%4d (%3d redundant) saved=%4d cells' % (
+            num_steps, stats['plan_requests'],
+            stats['hex_cells_requested'], stats['hex_redundant_cells'], stats['hex_cells_outside_area'],
+            stats['plan_cells_requested'], stats['plan_redundant_cells'],
+            stats['hex_cells_requested'] - stats['plan_cells_requested']))
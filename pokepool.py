@@ -0,0 +1,97 @@
+import logging
+import threading
+
+from Queue import Queue
+
+from pokeplan import plan_scan
+from pokesearch import Pokesteps
+from pokesent import Pokeseen
+
+logger = logging.getLogger(__name__)
+
+_WORKER_DONE = object()
+
+class Pokepool:
+    """ Splits the hex steps of a scan across several logged in Pokesearch
+    instances, one per account, each rate limited on its own thread.
+    """
+    def __init__(self, pokesearches, seen=None):
+        self.pokesearches = pokesearches
+        self.seen = seen if seen is not None else Pokeseen()
+
+    @property
+    def visible_range_meters(self):
+        # every worker has to use the same step spacing, so use the smallest visible range
+        return min(pokesearch.visible_range_meters for pokesearch in self.pokesearches)
+
+    def login(self, update_settings=True):
+        """ Logs every account in, drops the ones that can't and returns
+        False if none could.
+        """
+        logged_in = {}
+        def login(pokesearch):
+            logged_in[pokesearch] = pokesearch.login(update_settings)
+        threads = [threading.Thread(target=login, args=(pokesearch,)) for pokesearch in self.pokesearches]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [pokesearch.username for pokesearch in self.pokesearches if not logged_in.get(pokesearch)]
+        if failed:
+            logger.error('scanning without accounts that failed to login: %s', ', '.join(failed))
+            self.pokesearches = [pokesearch for pokesearch in self.pokesearches if logged_in.get(pokesearch)]
+        return len(self.pokesearches) > 0
+
+    def search(self, position, num_steps):
+        plan = plan_scan(position, num_steps, self.visible_range_meters)
+        return self.search_plan(plan, len(plan))
+
+    def search_plan(self, plan, total_steps=None):
+        steps = Pokesteps(plan)
+        results = Queue()
+        for pokesearch in self.pokesearches:
+            thread = threading.Thread(target=self._search_worker, args=(pokesearch, steps, results, self.seen))
+            thread.daemon = True
+            thread.start()
+
+        num_workers = len(self.pokesearches)
+        found = set()
+        step = 0
+        while num_workers > 0:
+            pokemons = results.get()
+            if pokemons is _WORKER_DONE:
+                num_workers -= 1
+                continue
+
+            for pokemon in pokemons:
+                if not pokemon.key in self.seen and not pokemon.key in found:
+                    found.add(pokemon.key)
+                    yield pokemon
+            step += 1
+            if total_steps:
+                logger.info('Completed {:5.2f}% of scan.'.format(float(step) / total_steps * 100))
+
+    def _search_worker(self, pokesearch, steps, results, seen):
+        try:
+            if not pokesearch.check_login():
+                return
+            while True:
+                step = steps.next()
+                if step is None:
+                    break
+                coord, cell_ids = step
+                # seen is only read here, the final dedup happens in search_plan
+                pokemons = pokesearch.search_step(coord, cell_ids, seen)
+                if pokemons is None:
+                    # give the step back to the workers, any of them can try it later
+                    steps.requeue(step)
+                    if not pokesearch.recover():
+                        logger.warn('worker %s giving up on scan, could not login again', pokesearch.username)
+                        break
+                    continue
+                results.put(pokemons)
+        except:
+            logger.warn('exception happened in search worker %s', pokesearch.username, exc_info=True)
+        finally:
+            results.put(_WORKER_DONE)
@@ -0,0 +1,222 @@
+import copy
+import json
+import logging
+import random
+import threading
+import time
+
+from pokesearch import DEFAULT_VISIBLE_RANGE_METERS
+
+logger = logging.getLogger(__name__)
+
+RECORDED_METHODS = ('get_map_objects', 'download_settings')
+
+class Pokerecorder(object):
+    """ Wraps a PGoApi and appends every get_map_objects and
+    download_settings request and its response to filename, one json record
+    per line, for replaying with Pokefakeapi.
+    """
+    lock = threading.Lock() # accounts in a pool share the recording file
+
+    def __init__(self, api, filename):
+        self.api = api
+        self.filename = filename
+        self.pending = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not name in RECORDED_METHODS:
+            return attr
+        def request(**kwargs):
+            self.pending.append((name, kwargs))
+            return attr(**kwargs)
+        return request
+
+    def call(self):
+        pending, self.pending = self.pending, []
+        response_dict = self.api.call()
+        if response_dict:
+            for name, kwargs in pending:
+                self._write(name, kwargs, response_dict)
+        return response_dict
+
+    def _write(self, name, kwargs, response_dict):
+        # only keep the part of the response that was asked for, the rest of
+        # the envelope holds auth tickets and raw bytes
+        key = name.upper()
+        record = {
+            'method': name,
+            'request': kwargs,
+            'response': {'responses': {key: response_dict.get('responses', {}).get(key)}},
+            'time': time.time()
+        }
+        try:
+            line = json.dumps(record)
+        except (TypeError, ValueError):
+            logger.warn('not recording a %s response that is not json serializable', name)
+            return
+        with Pokerecorder.lock:
+            with open(self.filename, 'a') as fp:
+                fp.write(line + '\n')
+
+def load_recording(filename):
+    records = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                records.append(json.loads(line))
+    logger.info('loaded %s recorded responses from %s', len(records), filename)
+    return records
+
+def shift_timestamps(response, offset_ms):
+    """ Moves every *_timestamp_ms in a response by offset_ms, so a response
+    recorded a while ago looks like it was just fetched.
+    """
+    if isinstance(response, dict):
+        for key, value in response.items():
+            if key.endswith('timestamp_ms') and isinstance(value, (int, long, float)) and value:
+                response[key] = value + offset_ms
+            else:
+                shift_timestamps(value, offset_ms)
+    elif isinstance(response, list):
+        for value in response:
+            shift_timestamps(value, offset_ms)
+    return response
+
+class Pokefakeapi(object):
+    """ Stands in for PGoApi and answers from recorded responses. Map
+    requests get the response recorded for the same cells, or the next one
+    in turn, after latency seconds. failure_rate of the calls fail, and so
+    do calls less than throttle_interval seconds after the one before, the
+    way the servers throttle.
+    """
+    def __init__(self, records, latency=0, failure_rate=0, seed=None, fresh=True, throttle_interval=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.throttle_interval = throttle_interval
+        self.last_call = None
+        self.random = random.Random(seed)
+        self.map_responses = {}
+        self.map_sequence = []
+        # recordings made before settings were recorded answer with the defaults
+        self.settings_response = make_settings_response()
+        now = time.time()
+        for record in records:
+            response = copy.deepcopy(record['response'])
+            if fresh and record.get('time'):
+                shift_timestamps(response, int((now - record['time']) * 1000))
+            if record['method'] == 'get_map_objects':
+                self.map_sequence.append(response)
+                cell_ids = record.get('request', {}).get('cell_id')
+                if cell_ids:
+                    self.map_responses[frozenset(cell_ids)] = response
+            elif record['method'] == 'download_settings':
+                self.settings_response = response
+        self.next_map = 0
+        self.pending = None
+        self.position = None
+        self.num_calls = 0
+        self.num_failures = 0
+        self._auth_provider = None
+
+    def set_position(self, lat, lng, alt):
+        self.position = (lat, lng, alt)
+
+    def login(self, auth_service, username, password):
+        self._auth_provider = _Fakeauth()
+        return True
+
+    def get_map_objects(self, **kwargs):
+        self.pending = ('get_map_objects', kwargs)
+
+    def download_settings(self, **kwargs):
+        self.pending = ('download_settings', kwargs)
+
+    def call(self):
+        name, kwargs = self.pending
+        self.pending = None
+        self.num_calls += 1
+        now = time.time()
+        throttled = self.throttle_interval and self.last_call is not None and now - self.last_call < self.throttle_interval
+        self.last_call = now
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled or (self.failure_rate and self.random.random() < self.failure_rate):
+            self.num_failures += 1
+            return {}
+        if name == 'download_settings':
+            return self.settings_response
+        response = self.map_responses.get(frozenset(kwargs.get('cell_id', ())))
+        if response is None and self.map_sequence:
+            response = self.map_sequence[self.next_map % len(self.map_sequence)]
+            self.next_map += 1
+        return response
+
+class _Fakeauth(object):
+    def __init__(self):
+        self._ticket_expire = long((time.time() + 3600) * 1000)
+
+def start_webhook_stub(fail_every=0, retry_after=1, latency=0, failure_rate=0, seed=None):
+    """ Starts a local stand-in for a slack webhook on a free port. Every
+    fail_every'th post is answered with a 429, failure_rate of the others
+    with a 500, each after latency seconds. Returns (url, posts), posts
+    gets a (time, payload, status) for every post.
+    """
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    posts = []
+    lock = threading.Lock()
+    failures = random.Random(seed)
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            with lock:
+                if fail_every and (len(posts) + 1) % fail_every == 0:
+                    status = 429
+                elif failure_rate and failures.random() < failure_rate:
+                    status = 500
+                else:
+                    status = 200
+                posts.append((time.time(), payload, status))
+            if latency:
+                time.sleep(latency)
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', str(retry_after))
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%s/' % server.server_port, posts
+
+def make_settings_response(visible_range_meters=DEFAULT_VISIBLE_RANGE_METERS):
+    return {'responses': {'DOWNLOAD_SETTINGS': {'settings': {'map_settings': {'pokemon_visible_range': visible_range_meters}}}}}
+
+def make_recording(plan, response_for_step):
+    """ A recording of one scan over plan, response_for_step(coord, cell_ids)
+    makes up each map response.
+    """
+    now = time.time()
+    records = [{
+        'method': 'download_settings',
+        'request': {},
+        'response': make_settings_response(),
+        'time': now
+    }]
+    for coord, cell_ids in plan:
+        records.append({
+            'method': 'get_map_objects',
+            'request': {'cell_id': list(cell_ids)},
+            'response': response_for_step(coord, cell_ids),
+            'time': now
+        })
+    return records
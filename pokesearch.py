@@ -2,18 +2,32 @@ import json
 import logging
 import math
 import random
+import threading
 import time
 
+from collections import deque
 from datetime import datetime
-from pgoapi.utilities import f2i
-from s2sphere import CellId, LatLng
 
-from pokedata import Pokedata, parse_map
+from pokecells import Pokecells
+from pokedata import Pokedata, iter_map
+from pokemetrics import Pokemetrics
+from pokeplan import plan_scan
+from pokesent import Pokeseen
 
 logger = logging.getLogger(__name__)
 
-REQ_SLEEP = 5
-MAX_NUM_RETRIES = 10
+REQ_SLEEP = 5 # starting delay between map requests, tuned as requests succeed or fail
+MIN_REQ_SLEEP = 1
+MAX_REQ_SLEEP = 30
+REQ_SLEEP_SPEEDUP = 0.9 # every request that succeeds shortens the delay by 10%
+REQ_SLEEP_SLOWDOWN = 1.5 # every failed one makes it 50% longer
+BACKOFF_SECONDS = 2 # retries wait up to BACKOFF_SECONDS * 2^attempt, with full jitter
+MAX_BACKOFF_SECONDS = 60
+DEFAULT_VISIBLE_RANGE_METERS = 70
+MAX_STEP_RETRIES = 3 # retries of a step before it is requeued
+MAX_STEP_REQUEUES = 2 # times a failed step is handed out again in the same scan
+MAX_FAILED_STEPS = 5 # steps failed in a row before logging in again
+MAX_LOGIN_ATTEMPTS = 10
 
 #Constants for Hex Grid
 #Gap between vertical and horzonal "rows"
@@ -27,171 +41,253 @@ lat_gap_degrees = float(lat_gap_meters) / meters_per_degree
 def calculate_lng_degrees(lat):
     return float(lng_gap_meters) / (meters_per_degree * math.cos(math.radians(lat)))
 
+class Pokethrottle:
+    """ Spaces out map requests by a delay that shrinks while requests
+    succeed and grows when they fail, so it settles just above whatever
+    rate the server starts throttling at, and hands out jittered
+    exponential backoffs for retries.
+    """
+    def __init__(self, delay=None, min_delay=MIN_REQ_SLEEP, max_delay=MAX_REQ_SLEEP, backoff=BACKOFF_SECONDS, max_backoff=MAX_BACKOFF_SECONDS,
+            clock=time.time, sleep=time.sleep, rand=random.random):
+        self.delay = float(delay if delay is not None else REQ_SLEEP)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff_seconds = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+        self.last = None
+
+    def wait(self):
+        # the time spent parsing the last response counts towards the delay
+        if self.last is not None:
+            remaining = self.last + self.delay - self.clock()
+            if remaining > 0:
+                self.sleep(remaining)
+        self.last = self.clock()
+
+    def succeeded(self):
+        self.delay = max(self.min_delay, self.delay * REQ_SLEEP_SPEEDUP)
+        Pokemetrics.set('request_delay_seconds', self.delay)
+
+    def failed(self):
+        self.delay = min(self.max_delay, max(self.min_delay, self.delay) * REQ_SLEEP_SLOWDOWN)
+        Pokemetrics.set('request_delay_seconds', self.delay)
+
+    def backoff(self, attempt):
+        return self.rand() * min(self.max_backoff, self.backoff_seconds * 2 ** attempt)
+
+class Pokesteps:
+    """ Hands out the steps of a plan, which can be a lazy generator, and
+    takes failed steps back to hand out again once another step went out,
+    up to MAX_STEP_REQUEUES times each. A plan can visit a step more than
+    once, every visit gets its own MAX_STEP_REQUEUES.
+    """
+    def __init__(self, plan):
+        self.lock = threading.Lock()
+        self.plan = iter(plan)
+        self.requeued = deque()
+        self.requeues = {}
+        self.visits = {}
+        self.num_handed = 0
+
+    def next(self):
+        with self.lock:
+            if self.requeued and self.requeued[0][0] < self.num_handed:
+                step = self.requeued.popleft()[1]
+            else:
+                step = next(self.plan, None)
+                if step is not None:
+                    self.visits[step[0]] = self.visits.get(step[0], 0) + 1
+                elif self.requeued:
+                    step = self.requeued.popleft()[1]
+            if step is not None:
+                self.num_handed += 1
+            return step
+
+    def requeue(self, step):
+        with self.lock:
+            coord = step[0]
+            num_requeues = self.requeues.get(coord, 0)
+            if num_requeues >= MAX_STEP_REQUEUES * self.visits.get(coord, 1):
+                logger.warn('skipping step at %s, %s after %s requeues', coord[0], coord[1], num_requeues)
+                Pokemetrics.inc('steps_skipped')
+                return False
+            self.requeues[coord] = num_requeues + 1
+            self.requeued.append((self.num_handed, step))
+            return True
+
 class Pokesearch:
-    def __init__(self, api, auth_service, username, password, position):
+    def __init__(self, api, auth_service, username, password, position, cells=None, throttle=None, seen=None):
         self.api = api
+        self.cells = cells if cells is not None else Pokecells()
+        # what the pipeline took from earlier scans and is still up, skipped
+        # before parsing, whoever consumes the scan adds to it
+        self.seen = seen if seen is not None else Pokeseen()
+        self.throttle = throttle if throttle is not None else Pokethrottle()
         self.auth_service = auth_service
         self.username = username
         self.password = password
         self.position = position
-        self.visible_range_meters = 70
-
-
-    def login(self):
+        self.visible_range_meters = DEFAULT_VISIBLE_RANGE_METERS
+        self.settings_updated = False
+        self.failed_steps = 0
+
+    def login(self, update_settings=True):
+        """ Logs in, retrying with backoff up to MAX_LOGIN_ATTEMPTS times,
+        returns False if it never got through.
+        """
         logger.info('login start with service: %s', self.auth_service)
 
         self.api.set_position(*self.position)
 
-        num_retries = 0
-        while not self.api.login(self.auth_service, self.username, self.password):
-            num_retries += 1
-            timeout = REQ_SLEEP * (int(num_retries / 5.0) + 1)
-            logger.warn('failed to login to pokemon go, retrying... timeout: %s, num_retries: %s', timeout, num_retries)
-            time.sleep(REQ_SLEEP * (int(num_retries / 5.0) + 1))
-
-        self._update_download_settings()
-
+        num_attempts = 1
+        with Pokemetrics.timer('login'):
+            while not self.api.login(self.auth_service, self.username, self.password):
+                if num_attempts >= MAX_LOGIN_ATTEMPTS:
+                    logger.error('failed to login to pokemon go as %s after %s attempts', self.username, num_attempts)
+                    return False
+                Pokemetrics.inc('retries', 'login')
+                timeout = self.throttle.backoff(num_attempts)
+                logger.warn('failed to login to pokemon go, retrying... timeout: %.1f, num_attempts: %s', timeout, num_attempts)
+                self.throttle.sleep(timeout)
+                num_attempts += 1
+
+        # at startup the settings can wait until after the first map request
+        if update_settings:
+            self._update_download_settings()
+
+        self.failed_steps = 0
         logger.info('login successful')
+        return True
 
-    def search(self, position, num_steps):
+    def check_login(self):
         if self.api._auth_provider and self.api._auth_provider._ticket_expire:
             if isinstance(self.api._auth_provider._ticket_expire, (int, long)):
                 remaining_time = self.api._auth_provider._ticket_expire / 1000.0 - time.time()
                 if remaining_time > 60:
                     logger.info("Skipping Pokemon Go login process since already logged in for another {:.2f} seconds".format(remaining_time))
-                else:
-                    self.login()
-            else:
-                logger.warn("skipping login since _ticket_expire was a token.")
-        else:
-            self.login()
+                    return True
+                return self.login()
+            logger.warn("skipping login since _ticket_expire was a token.")
+            return True
+        return self.login()
+
+    def recover(self):
+        """ Logs in again once MAX_FAILED_STEPS steps failed in a row,
+        returns False if the scan should give up.
+        """
+        if self.failed_steps < MAX_FAILED_STEPS:
+            return True
+        logger.warn('%s steps failed in a row, logging in again...', self.failed_steps)
+        return self.login()
+
+    def search(self, position, num_steps):
+        plan = plan_scan(position, num_steps, self.visible_range_meters)
+        return self.search_plan(plan, len(plan))
+
+    def search_plan(self, plan, total_steps=None):
+        if not self.check_login():
+            return
+
+        steps = Pokesteps(plan)
+        found = set()
+        num_done = 0
+        while True:
+            step = steps.next()
+            if step is None:
+                break
+            coord, cell_ids = step
+            pokemons = self.search_step(coord, cell_ids, self.seen)
+            if pokemons is None:
+                # try the step again later in the scan instead of giving up on all of it
+                steps.requeue(step)
+                if not self.recover():
+                    logger.error('giving up on scan, could not login again')
+                    return
+                continue
+
+            for pokemon in pokemons:
+                # overlapping steps see the same pokemon before it is taken
+                if not pokemon.key in found:
+                    found.add(pokemon.key)
+                    yield pokemon
+            num_done += 1
+            if total_steps:
+                logger.info('Completed {:5.2f}% of scan.'.format(float(num_done) / total_steps * 100))
 
-        all_pokemon = {}
-        num_retries = 0
+    def search_step(self, coord, cell_ids, seen=()):
+        """ Requests the map objects around coord, retrying with backoff up
+        to MAX_STEP_RETRIES times, returns None if the step failed.
+        """
+        from pgoapi.utilities import f2i
 
-        for step, coord in enumerate(generate_location_steps(position, num_steps, self.visible_range_meters), 1):
-            lat = coord[0]
-            lng = coord[1]
-            self.api.set_position(*coord)
+        lat = coord[0]
+        lng = coord[1]
+        self.api.set_position(*coord)
 
-            cell_ids = get_cell_ids(lat, lng)
-            timestamps = [0,] * len(cell_ids)
+        timestamps = self.cells.get_timestamps(coord, cell_ids)
 
-            response_dict = None
-            while not response_dict:
-                try:
+        response_dict = None
+        for attempt in xrange(MAX_STEP_RETRIES + 1):
+            self.throttle.wait()
+            try:
+                with Pokemetrics.timer('get_map_objects'):
                     self.api.get_map_objects(latitude = f2i(lat), longitude = f2i(lng), since_timestamp_ms = timestamps, cell_id = cell_ids)
                     response_dict = self.api.call()
-                except:
-                    logging.warn('exception happened on get_map_objects api call', exc_info=True)
-                if not response_dict:
-                    if num_retries < MAX_NUM_RETRIES:
-                        num_retries += 1
-                        logger.warn('get_map_objects failed, retrying in %s seconds, %s retries', REQ_SLEEP, num_retries)
-                        time.sleep(REQ_SLEEP)
-                    else:
-                        logger.warn('MAX_NUM_RETRIES exceeded, retrying login...')
-                        self.login()
-                        raise StopIteration
-
-            # try:
-            pokemons = parse_map(response_dict)
-            # except KeyError as e:
-            #     logger.error('failed to parse map with key error: %s', e)
-
-            for key in pokemons.keys():
-                if not key in all_pokemon:
-                    pokemon = pokemons[key]
-                    all_pokemon[key] = pokemon
-                    yield pokemon
-                # else:
-                #     logger.info("have duplicate poke: %s", key)
-            total_steps = (3 * (num_steps**2)) - (3 * num_steps) + 1
-            logger.info('Completed {:5.2f}% of scan.'.format(float(step) / total_steps * 100))
-            time.sleep(REQ_SLEEP)
+            except:
+                logging.warn('exception happened on get_map_objects api call', exc_info=True)
+            if response_dict:
+                self.throttle.succeeded()
+                break
+            # an empty answer is how the servers throttle, slow down
+            self.throttle.failed()
+            if attempt < MAX_STEP_RETRIES:
+                Pokemetrics.inc('retries', 'get_map_objects')
+                timeout = self.throttle.backoff(attempt + 1)
+                logger.warn('get_map_objects failed, retrying in %.1f seconds, %s retries', timeout, attempt + 1)
+                self.throttle.sleep(timeout)
+        if not response_dict:
+            self.failed_steps += 1
+            logger.warn('get_map_objects failed %s times, skipping step for now', MAX_STEP_RETRIES + 1)
+            return None
+        self.failed_steps = 0
+
+        # the response only holds what changed since our cell timestamps,
+        # the pokemon come from the cells with the changes merged in
+        self.cells.merge(coord, response_dict)
+
+        # try:
+        with Pokemetrics.timer('parse_map'):
+            pokemons = list(iter_map(self.cells.get_map_response(cell_ids), seen))
+        # except KeyError as e:
+        #     logger.error('failed to parse map with key error: %s', e)
+
+        if not self.settings_updated:
+            self._update_download_settings()
+
+        return pokemons
 
     def _update_download_settings(self):
-        visible_range_meters = 0
-        while visible_range_meters == 0:
+        for attempt in xrange(MAX_STEP_RETRIES + 1):
+            if attempt:
+                self.throttle.sleep(self.throttle.backoff(attempt))
             try:
                 logger.info('fetching download settings...')
-                self.api.download_settings(hash="05daf51635c82611d1aac95c0b051d3ec088a930")
-                response_dict = self.api.call()
+                self.throttle.wait()
+                with Pokemetrics.timer('download_settings'):
+                    self.api.download_settings(hash="05daf51635c82611d1aac95c0b051d3ec088a930")
+                    response_dict = self.api.call()
                 visible_range_meters = response_dict['responses']['DOWNLOAD_SETTINGS']['settings']['map_settings']['pokemon_visible_range']
-                self.visible_range_meters = float(visible_range_meters)
+                if visible_range_meters:
+                    self.visible_range_meters = float(visible_range_meters)
+                    break
             except:
+                Pokemetrics.inc('retries', 'download_settings')
                 logging.warn('exception happened on download_settings api call', exc_info=True)
+        else:
+            logger.warn('failed to fetch download settings, keeping the default visible range')
+        # don't hold up every following step on settings that won't come
+        self.settings_updated = True
         logger.info('download settings[pokemon_visible_range]: %s', self.visible_range_meters)
-
-def generate_location_steps(position, num_steps, visible_range_meters):
-    #Bearing (degrees)
-    NORTH = 0
-    EAST = 90
-    SOUTH = 180
-    WEST = 270
-
-    pulse_radius = visible_range_meters / 1000.0 # km - radius of players heartbeat is 100m
-    xdist = math.sqrt(3)*pulse_radius   # dist between column centers
-    ydist = 3*(pulse_radius/2)          # dist between row centers
-
-    yield (position[0], position[1], 0) #insert initial location
-
-    ring = 1
-    loc = position
-    while ring < num_steps:
-        #Set loc to start at top left
-        loc = get_new_coords(loc, ydist, NORTH)
-        loc = get_new_coords(loc, xdist/2, WEST)
-        for direction in range(6):
-            for i in range(ring):
-                if direction == 0: # RIGHT
-                    loc = get_new_coords(loc, xdist, EAST)
-                if direction == 1: # DOWN + RIGHT
-                    loc = get_new_coords(loc, ydist, SOUTH)
-                    loc = get_new_coords(loc, xdist/2, EAST)
-                if direction == 2: # DOWN + LEFT
-                    loc = get_new_coords(loc, ydist, SOUTH)
-                    loc = get_new_coords(loc, xdist/2, WEST)
-                if direction == 3: # LEFT
-                    loc = get_new_coords(loc, xdist, WEST)
-                if direction == 4: # UP + LEFT
-                    loc = get_new_coords(loc, ydist, NORTH)
-                    loc = get_new_coords(loc, xdist/2, WEST)
-                if direction == 5: # UP + RIGHT
-                    loc = get_new_coords(loc, ydist, NORTH)
-                    loc = get_new_coords(loc, xdist/2, EAST)
-                yield (loc[0], loc[1], 0)
-        ring += 1
-
-def get_new_coords(init_loc, distance, bearing):
-    """ Given an initial lat/lng, a distance(in kms), and a bearing (degrees),
-    this will calculate the resulting lat/lng coordinates.
-    """
-    R = 6378.1 #km radius of the earth
-    bearing = math.radians(bearing)
-
-    init_coords = [math.radians(init_loc[0]), math.radians(init_loc[1])] # convert lat/lng to radians
-
-    new_lat = math.asin( math.sin(init_coords[0])*math.cos(distance/R) +
-        math.cos(init_coords[0])*math.sin(distance/R)*math.cos(bearing))
-
-    new_lon = init_coords[1] + math.atan2(math.sin(bearing)*math.sin(distance/R)*math.cos(init_coords[0]),
-        math.cos(distance/R)-math.sin(init_coords[0])*math.sin(new_lat))
-
-    return [math.degrees(new_lat), math.degrees(new_lon)]
-
-def get_cell_ids(lat, lng, radius = 10):
-    origin = CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).parent(15)
-    walk = [origin.id()]
-    right = origin.next()
-    left = origin.prev()
-
-    # Search around provided radius
-    for i in range(radius):
-        walk.append(right.id())
-        walk.append(left.id())
-        right = right.next()
-        left = left.prev()
-
-    # Return everything
-    return sorted(walk)
@@ -0,0 +1,111 @@
+import calendar
+import heapq
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_SENT_POKEMON = 100000
+MAX_SEEN_POKEMON = 100000
+
+class Pokesent:
+    """ Keys of the pokemon already sent to slack. Entries expire at the
+    pokemon's disappear_time, the soonest to expire are dropped first once
+    max_size is reached, and with a filename the index survives restarts.
+    """
+    def __init__(self, filename=None, max_size=MAX_SENT_POKEMON):
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.max_size = max_size
+        self.expires = {}
+        self.queue = []
+        self.fp = None
+        self.num_lines = 0
+
+    def load(self):
+        if not self.filename:
+            return
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as fp:
+                for line in fp:
+                    try:
+                        key, expire = line.rstrip('\n').rsplit(' ', 1)
+                        self._add(key, int(expire))
+                    except ValueError:
+                        logger.warn('skipping bad line in %s: %s', self.filename, line)
+            logger.info('loaded %s sent pokemon from %s', len(self.expires), self.filename)
+        self._compact()
+
+    def __contains__(self, key):
+        with self.lock:
+            expire = self.expires.get(key)
+            return expire is not None and expire > time.time()
+
+    def __len__(self):
+        return len(self.expires)
+
+    def add(self, key, disappear_time):
+        expire = calendar.timegm(disappear_time.timetuple())
+        with self.lock:
+            self._add(key, expire)
+            if self.fp:
+                self.fp.write('%s %d\n' % (key, expire))
+                self.fp.flush()
+                self.num_lines += 1
+                if self.num_lines > 2 * self.max_size:
+                    self._compact()
+
+    def _add(self, key, expire):
+        if self.expires.get(key) == expire:
+            return
+        self.expires[key] = expire
+        heapq.heappush(self.queue, (expire, key))
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        while self.queue and (self.queue[0][0] <= now or len(self.expires) > self.max_size):
+            expire, key = heapq.heappop(self.queue)
+            # only drop the key if this is its latest entry
+            if self.expires.get(key) == expire:
+                del self.expires[key]
+
+    def _compact(self):
+        # rewrite the log with only the live entries and keep appending to it
+        if self.fp:
+            self.fp.close()
+        self._evict()
+        self.queue = [(expire, key) for key, expire in self.expires.items()]
+        heapq.heapify(self.queue)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            for key, expire in self.expires.items():
+                fp.write('%s %d\n' % (key, expire))
+        os.rename(tmp_filename, self.filename)
+        self.fp = open(self.filename, 'a')
+        self.num_lines = len(self.expires)
+
+class Pokeseen(Pokesent):
+    """ Keys of the pokemon the pipeline has taken, kept until they
+    disappear. Scans pass it to iter_map as seen, so a pokemon still up from
+    an earlier scan is skipped before it gets built, filtered or logged
+    again. An alert that gets dropped is discarded so the next scan finds it
+    again.
+    """
+    def __init__(self, max_size=MAX_SEEN_POKEMON):
+        Pokesent.__init__(self, None, max_size)
+
+    def add_pokemon(self, pokemon):
+        with self.lock:
+            self._add(pokemon.key, pokemon.disappear_time_ms // 1000)
+
+    def discard(self, key):
+        # the stale heap entry is skipped when it comes up in _evict
+        with self.lock:
+            self.expires.pop(key, None)
+
+    def keys(self):
+        with self.lock:
+            return list(self.expires)
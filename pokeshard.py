@@ -0,0 +1,211 @@
+import logging
+import multiprocessing
+import threading
+
+from Queue import Empty
+
+from pokedata import Pokemon
+from pokemetrics import Pokemetrics
+from pokeplan import get_sector, plan_scan
+from pokesearch import DEFAULT_VISIBLE_RANGE_METERS, Pokesteps
+from pokesent import Pokeseen
+
+logger = logging.getLogger(__name__)
+
+RESULT_TIMEOUT_SECONDS = 5 # how often to check that the shards being waited on are still alive
+
+class Pokeshards:
+    """ Splits the hex grid into pie slice sectors around position and scans
+    each one from its own worker process with its own Pokesearch, so
+    parsing and building pokemon run on every core. Workers send compact
+    sighting records back and the coordinator, this process, does the
+    global dedup and hands the pokemon on to the pipeline and slack.
+
+    The workers are forked when this is made, create it before starting
+    any threads. They record metrics if Pokemetrics is enabled by then and
+    send them along when they finish a scan. A shard whose process dies is
+    dropped, the others carry on without it.
+    """
+    def __init__(self, make_searches, position):
+        # make_searches are called in the worker processes, one Pokesearch each
+        self.position = position
+        self.results = multiprocessing.Queue()
+        self.shards = []
+        self.processes = []
+        for shard, make_search in enumerate(make_searches):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_shard_worker, args=(shard, make_search, tasks, self.results))
+            process.daemon = True
+            process.start()
+            self.shards.append(tasks)
+            self.processes.append(process)
+        self.visible_ranges = {}
+        self.seen = Pokeseen()
+
+    @property
+    def visible_range_meters(self):
+        # every shard has to use the same step spacing, so use the smallest visible range
+        return min(self.visible_ranges.values() or [DEFAULT_VISIBLE_RANGE_METERS])
+
+    def login(self, update_settings=True):
+        """ Logs every shard in, stops the ones that can't and returns False
+        if none could.
+        """
+        waiting = set(shard for shard, tasks in enumerate(self.shards) if tasks)
+        for shard in waiting:
+            self.shards[shard].put(('login', update_settings))
+        failed = []
+        while waiting:
+            message, shard, ok, visible_range_meters = self._get_result(waiting)
+            waiting.discard(shard)
+            if ok:
+                self.visible_ranges[shard] = visible_range_meters
+            else:
+                failed.append(shard)
+        if failed:
+            logger.error('scanning without %s shards that failed to login', len(failed))
+            for shard in failed:
+                self._drop(shard)
+        return len(self.visible_ranges) > 0
+
+    def search(self, position, num_steps):
+        plan = plan_scan(position, num_steps, self.visible_range_meters)
+        return self.search_plan(plan, len(plan))
+
+    def search_plan(self, plan, total_steps=None):
+        shards = [shard for shard, tasks in enumerate(self.shards) if tasks]
+        # the workers skip what the pipeline already took, as of the start of the scan
+        seen_keys = self.seen.keys()
+        for shard in shards:
+            self.shards[shard].put(('scan', seen_keys))
+        # the plan may be a lazy schedule, hand out its steps from a thread
+        thread = threading.Thread(target=self._dispatch, args=(plan, shards))
+        thread.daemon = True
+        thread.start()
+
+        working = set(shards)
+        found = set()
+        step = 0
+        while working:
+            message, shard, records, visible_range_meters = self._get_result(working)
+            if message == 'lost':
+                working.discard(shard)
+                self._drop(shard)
+                continue
+            if message == 'done':
+                # the worker's metrics for the scan
+                Pokemetrics.merge(records)
+                self.visible_ranges[shard] = visible_range_meters
+                working.discard(shard)
+                continue
+
+            for record in records:
+                if not record[0] in self.seen and not record[0] in found:
+                    found.add(record[0])
+                    yield _from_record(record)
+            step += 1
+            if total_steps:
+                logger.info('Completed {:5.2f}% of scan.'.format(float(step) / total_steps * 100))
+
+    def _get_result(self, waiting):
+        """ The next message from a shard, or ('lost', shard, None, None)
+        once one of the waiting shards' process has died.
+        """
+        while True:
+            try:
+                return self.results.get(timeout=RESULT_TIMEOUT_SECONDS)
+            except Empty:
+                for shard in waiting:
+                    if not self.processes[shard].is_alive():
+                        logger.error('shard %s died with exit code %s', shard, self.processes[shard].exitcode)
+                        return ('lost', shard, None, None)
+
+    def _drop(self, shard):
+        if self.processes[shard].is_alive():
+            self.shards[shard].put(('stop', None))
+        self.shards[shard] = None
+        self.visible_ranges.pop(shard, None)
+
+    def _dispatch(self, plan, shards):
+        for coord, cell_ids in plan:
+            shard = shards[get_sector(self.position, coord, len(shards))]
+            tasks = self.shards[shard]
+            # the sector of a shard that was dropped is lost for this scan
+            if tasks:
+                tasks.put(('step', (coord, cell_ids)))
+        for shard in shards:
+            tasks = self.shards[shard]
+            if tasks:
+                tasks.put(('end', None))
+
+def _shard_worker(shard, make_search, tasks, results):
+    # always answer, the coordinator waits for every shard
+    try:
+        pokesearch = make_search()
+    except:
+        logger.error('could not make the search of shard worker %s', shard, exc_info=True)
+        pokesearch = None
+    while True:
+        command, arg = tasks.get()
+        if command == 'login':
+            try:
+                ok = pokesearch is not None and pokesearch.login(arg)
+            except:
+                logger.warn('exception happened logging in shard worker %s', shard, exc_info=True)
+                ok = False
+            results.put(('login', shard, ok, pokesearch.visible_range_meters if ok else None))
+        elif command == 'scan':
+            sector = _iter_steps(tasks)
+            try:
+                _scan_sector(pokesearch, sector, results, shard, set(arg))
+            except:
+                logger.warn('exception happened in shard worker %s', shard, exc_info=True)
+            # whatever is left of the sector is lost for this scan
+            for step in sector:
+                pass
+            results.put(('done', shard, Pokemetrics.take(), pokesearch.visible_range_meters))
+        elif command == 'stop':
+            break
+
+def _scan_sector(pokesearch, sector, results, shard, seen):
+    if not pokesearch.check_login():
+        return
+    steps = Pokesteps(sector)
+    while True:
+        step = steps.next()
+        if step is None:
+            break
+        coord, cell_ids = step
+        pokemons = pokesearch.search_step(coord, cell_ids, seen)
+        if pokemons is None:
+            steps.requeue(step)
+            if not pokesearch.recover():
+                logger.warn('shard %s giving up on scan, could not login again', shard)
+                break
+            continue
+        # only for this scan, the coordinator decides what is seen for good
+        seen.update(pokemon.key for pokemon in pokemons)
+        results.put(('step', shard, [_to_record(pokemon) for pokemon in pokemons], None))
+
+def _iter_steps(tasks):
+    # the steps of the current scan, up to its end marker
+    while True:
+        command, step = tasks.get()
+        if command != 'step':
+            return
+        yield step
+
+# pokemon cross the process boundary as plain tuples, far cheaper to pickle
+def _to_record(pokemon):
+    return (pokemon.key, pokemon.pokemon_id, pokemon.position[0], pokemon.position[1], pokemon.disappear_time_ms,
+        pokemon.encounter_id, pokemon.spawnpoint_id, pokemon.from_lure, pokemon.pokestop_id)
+
+def _from_record(record):
+    return Pokemon(
+        record[1],
+        (record[2], record[3], 0),
+        record[4],
+        encounter_id=record[5],
+        spawnpoint_id=record[6],
+        from_lure=record[7],
+        pokestop_id=record[8])
@@ -2,45 +2,96 @@
 
 import json
 import logging
-import requests
+import time
 
 from datetime import datetime
 from pokeconfig import Pokeconfig
+from pokedelivery import make_payload
+from pokefilter import filter_sendable, score_sendable
+from pokemetrics import Pokemetrics
+from pokesent import Pokesent
 
 logger = logging.getLogger(__name__)
 
 class Pokeslack:
-    def __init__(self, rarity_limit, slack_webhook_url):
-        self.sent_pokemon = {}
+    # set by main to report the time from process start to the first alert
+    started_at = None
+    first_alert_at = None
+
+    def __init__(self, rarity_limit, slack_webhook_url, sent_pokemon=None, delivery=None, position=None, name=None):
+        self.sent_pokemon = sent_pokemon if sent_pokemon is not None else Pokesent()
+        self.pending_pokemon = set()
+        self.delivery = delivery
         self.rarity_limit = rarity_limit
         self.slack_webhook_url = slack_webhook_url
+        # a region's own center, and its name to keep its sent keys apart from other regions
+        self.position = position
+        self.name = name
+
+    def get_position(self):
+        return self.position or Pokeconfig.get().position
+
+    def get_sent_key(self, pokemon):
+        if self.name:
+            return '%s:%s' % (self.name, pokemon.key)
+        return pokemon.key
 
     def try_send_pokemon(self, pokemon, debug):
+        if self.should_send(pokemon):
+            self.send_pokemon(pokemon)
 
+    def should_send(self, pokemon):
         if pokemon.expires_in().total_seconds() < Pokeconfig.EXPIRE_BUFFER_SECONDS:
             logger.info('skipping pokemon since it expires too soon')
-            return
+            Pokemetrics.inc('alerts_skipped', 'expiry')
+            return False
 
         if pokemon.rarity < self.rarity_limit:
             logger.info('skipping pokemon since its rarity is too low')
-            return
+            Pokemetrics.inc('alerts_skipped', 'rarity')
+            return False
 
-        padded_distance = pokemon.get_distance() * 1.1
+        position = self.get_position()
+        padded_distance = pokemon.get_distance(position) * 1.1
         walk_distance_per_second = Pokeconfig.WALK_METERS_PER_SECOND if Pokeconfig.get().distance_unit == 'meters' else Pokeconfig.WALK_MILES_PER_SECOND
         travel_time = padded_distance / walk_distance_per_second
         if pokemon.expires_in().total_seconds() < travel_time:
-            logger.info('skipping pokemon since it\'s too far: traveltime=%s for distance=%s', travel_time, pokemon.get_distance_str())
-            return
+            logger.info('skipping pokemon since it\'s too far: traveltime=%s for distance=%s', travel_time, pokemon.get_distance_str(position))
+            Pokemetrics.inc('alerts_skipped', 'distance')
+            return False
 
-        pokemon_key = pokemon.key
+        pokemon_key = self.get_sent_key(pokemon)
         if pokemon_key in self.sent_pokemon:
             logger.info('already sent this pokemon to slack with key %s', pokemon_key)
+            Pokemetrics.inc('alerts_skipped', 'duplicate')
+            return False
+
+        return True
+
+    def filter_sendable(self, pokemons):
+        with Pokemetrics.timer('filter'):
+            sendable = filter_sendable(pokemons, self.get_position(), self.rarity_limit)
+            num_sendable = len(sendable)
+            sendable = [pokemon for pokemon in sendable if not self.get_sent_key(pokemon) in self.sent_pokemon and not self.get_sent_key(pokemon) in self.pending_pokemon]
+        Pokemetrics.inc('alerts_skipped', 'duplicate', num_sendable - len(sendable))
+        logger.info('%s of %s pokemon are worth sending', len(sendable), len(pokemons))
+        return sendable
+
+    def score_sendable(self, pokemons):
+        return score_sendable(pokemons, self.get_position())
+
+    def send_pokemon(self, pokemon, priority=0, on_dropped=None):
+        pokemon_key = self.get_sent_key(pokemon)
+        if pokemon_key in self.sent_pokemon or pokemon_key in self.pending_pokemon:
+            return
+        # it may have been waiting in the delivery queue for a while
+        if pokemon.expires_in().total_seconds() < Pokeconfig.EXPIRE_BUFFER_SECONDS:
+            logger.info('skipping pokemon since it expired while queued')
             return
 
         from_lure = ', from a lure' if pokemon.from_lure else ''
-        miles_away = pokemon.get_distance_str()
-
-        position = Pokeconfig.get().position
+        position = self.get_position()
+        miles_away = pokemon.get_distance_str(position)
 
         pokedex_url = 'http://www.pokemon.com/us/pokedex/%s' % pokemon.pokemon_id
         map_url = 'http://maps.google.com?saddr=%s,%s&daddr=%s,%s&directionsmode=walking' % (position[0], position[1], pokemon.position[0], pokemon.position[1])
@@ -52,16 +103,36 @@ class Pokeslack:
             message = '*%s*' % message
 
         logging.info('%s: %s', pokemon_key, message)
-        if self._send(message):
-            self.sent_pokemon[pokemon_key] = True
+        if self.delivery:
+            self.pending_pokemon.add(pokemon_key)
+            self.delivery.put(message, lambda sent: self._on_sent(pokemon_key, pokemon, sent, on_dropped), priority)
+        elif self._send(message):
+            self._sent(pokemon_key, pokemon)
+        else:
+            Pokemetrics.inc('alerts_dropped', 'delivery')
+            if on_dropped:
+                on_dropped(pokemon)
+
+    def _on_sent(self, pokemon_key, pokemon, sent, on_dropped=None):
+        self.pending_pokemon.discard(pokemon_key)
+        if sent:
+            self._sent(pokemon_key, pokemon)
+        elif on_dropped:
+            on_dropped(pokemon)
+
+    def _sent(self, pokemon_key, pokemon):
+        self.sent_pokemon.add(pokemon_key, pokemon.disappear_time)
+        Pokemetrics.inc('alerts_sent')
+        if Pokeslack.started_at and not Pokeslack.first_alert_at:
+            Pokeslack.first_alert_at = time.time()
+            logger.info('time to first alert: %.2f seconds', Pokeslack.first_alert_at - Pokeslack.started_at)
+            Pokemetrics.set('time_to_first_alert_seconds', Pokeslack.first_alert_at - Pokeslack.started_at)
 
     def _send(self, message):
-        payload = {
-            'username': 'Poké Alert!',
-            'text': message,
-            'icon_emoji': ':ghost:'
-        }
+        payload = make_payload([message])
         s = json.dumps(payload)
-        r = requests.post(self.slack_webhook_url, data=s)
+        import requests
+        with Pokemetrics.timer('slack_post'):
+            r = requests.post(self.slack_webhook_url, data=s)
         logger.info('slack post result: %s, %s', r.status_code, r.reason)
         return r.status_code == 200
@@ -0,0 +1,181 @@
+import heapq
+import json
+import logging
+import os
+import struct
+import time
+
+from pokedata import iter_map
+from pokeplan import get_visible_cell_ids
+
+logger = logging.getLogger(__name__)
+
+SPAWN_CYCLE_SECONDS = 3600 # spawn points spawn once an hour at the same second
+SPAWN_DURATION_SECONDS = 900 # and stay up for 15 minutes
+SCAN_DELAY_SECONDS = 30 # visit a spawn point this long after it is expected to spawn
+GROUP_WINDOW_SECONDS = 60 # a visit waits this long at most for other spawn points in range to come due
+
+class Pokespawns:
+    """ Learns when each spawn point spawns from the pokemon seen on it and
+    schedules visits to spawn points shortly after they are due, instead of
+    rescanning the whole hex grid.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.spawnpoints = {}
+
+    def load(self):
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename, 'r') as fp:
+                self.spawnpoints = json.load(fp)
+            logger.info('loaded %s spawn points from %s', len(self.spawnpoints), self.filename)
+
+    def save(self):
+        if self.filename:
+            with open(self.filename, 'w') as fp:
+                json.dump(self.spawnpoints, fp)
+
+    def record(self, pokemon):
+        if pokemon.from_lure or not pokemon.spawnpoint_id:
+            return
+        disappear_seconds = pokemon.disappear_time_ms // 1000
+        self.spawnpoints[pokemon.spawnpoint_id] = {
+            'latitude': pokemon.position[0],
+            'longitude': pokemon.position[1],
+            'spawn_second': (disappear_seconds - SPAWN_DURATION_SECONDS) % SPAWN_CYCLE_SECONDS
+        }
+
+    def record_map(self, response_dict):
+        for pokemon in iter_map(response_dict):
+            self.record(pokemon)
+
+    def next_due(self, spawnpoint_id, now):
+        spawn_second = self.spawnpoints[spawnpoint_id]['spawn_second']
+        due = now - now % SPAWN_CYCLE_SECONDS + spawn_second + SCAN_DELAY_SECONDS
+        if due > now:
+            # the spawn from the previous hour may still be up
+            if due - SPAWN_CYCLE_SECONDS + SPAWN_DURATION_SECONDS - SCAN_DELAY_SECONDS > now + GROUP_WINDOW_SECONDS:
+                return now
+            return due
+        if due + SPAWN_DURATION_SECONDS - SCAN_DELAY_SECONDS > now + GROUP_WINDOW_SECONDS:
+            return now
+        return due + SPAWN_CYCLE_SECONDS
+
+    def due_after(self, spawnpoint_id, now):
+        spawn_second = self.spawnpoints[spawnpoint_id]['spawn_second']
+        due = now - now % SPAWN_CYCLE_SECONDS + spawn_second + SCAN_DELAY_SECONDS
+        while due <= now:
+            due += SPAWN_CYCLE_SECONDS
+        return due
+
+    def build_queue(self, now):
+        queue = [(self.next_due(spawnpoint_id, now), spawnpoint_id) for spawnpoint_id in self.spawnpoints]
+        heapq.heapify(queue)
+        return queue
+
+    def iter_visits(self, duration_seconds, visible_range_meters, clock=time.time, sleep=time.sleep):
+        """ Yields (coord, cell_ids) steps for the next duration_seconds,
+        sleeping until each one is due.
+        """
+        from geopy.distance import vincenty
+        now = clock()
+        end = now + duration_seconds
+        queue = self.build_queue(now)
+        while queue and queue[0][0] < end:
+            due, spawnpoint_id = heapq.heappop(queue)
+            spawnpoint = self.spawnpoints[spawnpoint_id]
+            coord = (spawnpoint['latitude'], spawnpoint['longitude'], 0)
+
+            # anything else in range that is due soon gets covered by this
+            # visit, which waits until the last of them is due so none of
+            # them is visited before it spawns
+            covered = []
+            for entry in queue:
+                other = self.spawnpoints[entry[1]]
+                if entry[0] <= due + GROUP_WINDOW_SECONDS and vincenty(coord, (other['latitude'], other['longitude'])).meters <= visible_range_meters:
+                    covered.append(entry)
+            if covered:
+                due = max(due, max(entry[0] for entry in covered))
+                queue = [entry for entry in queue if not entry in covered]
+            # a visit to a spawn still up from the last hour must not skip
+            # this hour's spawn, so the next visit is to the next spawn after it
+            queue.extend((self.due_after(entry[1], due), entry[1]) for entry in covered + [(due, spawnpoint_id)])
+            heapq.heapify(queue)
+
+            wait = due - clock()
+            if wait > 0:
+                sleep(wait)
+            yield coord, get_visible_cell_ids(coord[0], coord[1], visible_range_meters)
+
+    def simulate_visits(self, duration_seconds, visible_range_meters, start=None):
+        """ The (time, coord) of each visit over duration_seconds, without waiting. """
+        clock = [start if start is not None else time.time()]
+        def sleep(seconds):
+            clock[0] += seconds
+        visits = self.iter_visits(duration_seconds, visible_range_meters, clock=lambda: clock[0], sleep=sleep)
+        return [(clock[0], coord) for coord, cell_ids in visits]
+
+    def measure_visits(self, visits, visible_range_meters):
+        """ Replays (time, coord) visits against the learned spawn points.
+        A spawn is caught by the first visit in range while it is up. Returns
+        (num_caught, mean seconds from spawn to being caught).
+        """
+        import numpy as np
+        from pokefilter import get_distances_meters
+        spawnpoint_ids = list(self.spawnpoints)
+        latitudes = np.array([self.spawnpoints[spawnpoint_id]['latitude'] for spawnpoint_id in spawnpoint_ids])
+        longitudes = np.array([self.spawnpoints[spawnpoint_id]['longitude'] for spawnpoint_id in spawnpoint_ids])
+        spawn_seconds = np.array([self.spawnpoints[spawnpoint_id]['spawn_second'] for spawnpoint_id in spawnpoint_ids])
+        caught = {}
+        for t, coord in visits:
+            up_for = (t - spawn_seconds) % SPAWN_CYCLE_SECONDS
+            in_range = get_distances_meters(coord, latitudes, longitudes) <= visible_range_meters
+            for i in np.flatnonzero(in_range & (up_for < SPAWN_DURATION_SECONDS)).tolist():
+                # one spawn per spawn point and hour, keyed by when it spawned
+                spawn = (spawnpoint_ids[i], int(round(t - up_for[i])))
+                if not spawn in caught:
+                    caught[spawn] = up_for[i]
+        mean_seconds = sum(caught.values()) / len(caught) if caught else 0
+        return len(caught), mean_seconds
+
+    def count_visits(self, duration_seconds, visible_range_meters, start=None):
+        """ Counts the visits needed over duration_seconds without waiting. """
+        return len(self.simulate_visits(duration_seconds, visible_range_meters, start))
+
+def _i2f(value):
+    # map requests carry their position the way pgoapi's f2i packs it
+    return struct.unpack('<d', struct.pack('<Q', value))[0]
+
+if __name__ == '__main__':
+    # learn spawn points offline from a recording of map responses, then
+    # compare an hour of scheduled visits with rescanning the recorded steps
+    # for the spawns caught per map request and how soon after spawning, e.g.
+    # python pokespawns.py recorded.jsonl 70
+    import sys
+    from pokereplay import load_recording
+    from pokesearch import REQ_SLEEP
+    pokespawns = Pokespawns()
+    steps = []
+    for record in load_recording(sys.argv[1]):
+        if record['method'] == 'get_map_objects':
+            pokespawns.record_map(record['response'])
+            request = record.get('request', {})
+            if 'latitude' in request:
+                step = (_i2f(request['latitude']), _i2f(request['longitude']))
+                if not step in steps:
+                    steps.append(step)
+    visible_range_meters = float(sys.argv[2]) if len(sys.argv) > 2 else 70
+    search_timeout = 30 # what main waits between full scans
+    start = time.time()
+    print('learned %s spawn points, each spawns once an hour' % len(pokespawns.spawnpoints))
+    modes = [('spawns', pokespawns.simulate_visits(SPAWN_CYCLE_SECONDS, visible_range_meters, start))]
+    if steps:
+        cycle_seconds = len(steps) * REQ_SLEEP + search_timeout
+        modes.append(('hex', [(start + cycle * cycle_seconds + i * REQ_SLEEP, step)
+            for cycle in xrange(int(SPAWN_CYCLE_SECONDS / cycle_seconds) + 1)
+            for i, step in enumerate(steps)
+            if cycle * cycle_seconds + i * REQ_SLEEP < SPAWN_CYCLE_SECONDS]))
+    for mode, visits in modes:
+        num_caught, mean_seconds = pokespawns.measure_visits(visits, visible_range_meters)
+        print('%s: %s map requests, %s spawns caught, %.2f per request, caught %.0fs after spawning on average' % (
+            mode, len(visits), num_caught, num_caught / float(max(len(visits), 1)), mean_seconds))
@@ -0,0 +1,121 @@
+import logging
+
+from datetime import datetime
+
+from pokedata import Pokemon, _to_millis
+
+logger = logging.getLogger(__name__)
+
+class Pokestore:
+    """ Append only sqlite store of every pokemon sighting, keyed by the
+    encounter/lure key and disappear time, replacing the
+    cached_pokedata.json rewrite. A lure key comes back every time the same
+    pokemon shows up at the same pokestop, its disappear time tells the
+    sightings apart.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+
+    def _connect(self):
+        # opened on first use, so sqlite isn't loaded before the first scan
+        if self.db is not None:
+            return self.db
+        import sqlite3
+        self.db = sqlite3.connect(self.filename)
+        old = self.db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sightings'").fetchone()
+        migrate = old is not None and 'key TEXT PRIMARY KEY' in old[0]
+        if migrate:
+            # stores made before lure keys could repeat, move them over to the new key
+            logger.info('migrating %s to key sightings by key and disappear time', self.filename)
+            self.db.executescript('''
+                ALTER TABLE sightings RENAME TO sightings_old;
+                DROP INDEX IF EXISTS sightings_disappear_time;
+                DROP INDEX IF EXISTS sightings_pokemon_id;
+                DROP INDEX IF EXISTS sightings_spawnpoint_id;
+            ''')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS sightings (
+                key TEXT NOT NULL,
+                pokemon_id INTEGER NOT NULL,
+                encounter_id TEXT,
+                spawnpoint_id TEXT,
+                pokestop_id TEXT,
+                from_lure INTEGER NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                disappear_time INTEGER NOT NULL,
+                PRIMARY KEY (key, disappear_time)
+            );
+            CREATE INDEX IF NOT EXISTS sightings_disappear_time ON sightings (disappear_time);
+            CREATE INDEX IF NOT EXISTS sightings_pokemon_id ON sightings (pokemon_id, disappear_time);
+            CREATE INDEX IF NOT EXISTS sightings_spawnpoint_id ON sightings (spawnpoint_id, disappear_time);
+        ''')
+        if migrate:
+            with self.db:
+                self.db.execute('INSERT OR IGNORE INTO sightings SELECT * FROM sightings_old')
+                self.db.execute('DROP TABLE sightings_old')
+        return self.db
+
+    def add(self, pokemons):
+        """ Stores the sightings that aren't stored yet, returns how many. """
+        rows = [(
+            pokemon.key,
+            pokemon.pokemon_id,
+            pokemon.encounter_id,
+            pokemon.spawnpoint_id,
+            pokemon.pokestop_id if pokemon.from_lure else None,
+            int(pokemon.from_lure),
+            pokemon.position[0],
+            pokemon.position[1],
+            pokemon.disappear_time_ms
+        ) for pokemon in pokemons]
+        db = self._connect()
+        with db:
+            return db.executemany('INSERT OR IGNORE INTO sightings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows).rowcount
+
+    def query(self, start=None, end=None, pokemon_id=None, spawnpoint_id=None):
+        """ Returns the sightings disappearing between start and end
+        (datetimes), optionally only for one pokemon_id or spawnpoint.
+        """
+        clauses = []
+        params = []
+        if pokemon_id is not None:
+            clauses.append('pokemon_id = ?')
+            params.append(pokemon_id)
+        if spawnpoint_id is not None:
+            clauses.append('spawnpoint_id = ?')
+            params.append(spawnpoint_id)
+        if start is not None:
+            clauses.append('disappear_time >= ?')
+            params.append(_to_millis(start))
+        if end is not None:
+            clauses.append('disappear_time < ?')
+            params.append(_to_millis(end))
+        sql = 'SELECT * FROM sightings'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY disappear_time'
+        return [_from_row(row) for row in self._connect().execute(sql, params)]
+
+    def get_live(self):
+        return self.query(start=datetime.utcnow())
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sightings').fetchone()[0]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def _from_row(row):
+    from_lure = bool(row[5])
+    return Pokemon(
+        row[1],
+        (row[6], row[7], 0),
+        row[8],
+        encounter_id=row[2],
+        spawnpoint_id=row[3],
+        from_lure=from_lure,
+        pokestop_id=row[4] if from_lure else 0)
@@ -1,14 +1,51 @@
+import json
 import logging
-
-from geopy.geocoders import GoogleV3
+import os
+import re
 
 logger = logging.getLogger(__name__)
 
-def get_pos_by_name(location_name):
-    geolocator = GoogleV3()
+GEOCODE_CACHE_FILENAME = 'geocode_cache.json'
+
+LATLNG_RE = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+def get_pos_by_name(location_name, cache_filename=GEOCODE_CACHE_FILENAME, geolocator=None):
+    # coordinates like "37.7749,-122.4194" need no geocoding at all
+    match = LATLNG_RE.match(location_name)
+    if match:
+        return (float(match.group(1)), float(match.group(2)), 0), location_name
+
+    cache = _load_geocode_cache(cache_filename)
+    if location_name in cache:
+        cached = cache[location_name]
+        logger.debug('using cached location for %s', location_name)
+        return tuple(cached['position']), cached['address'].encode('utf-8')
+
+    if not geolocator:
+        # only pay for importing the geocoder when the cache misses
+        from geopy.geocoders import GoogleV3
+        geolocator = GoogleV3()
     loc = geolocator.geocode(location_name, timeout=10)
 
     logger.debug('location: %s', loc.address.encode('utf-8'))
     logger.debug('lat, long, alt: %s, %s, %s', loc.latitude, loc.longitude, loc.altitude)
 
-    return (loc.latitude, loc.longitude, loc.altitude), loc.address.encode('utf-8')
+    position = (loc.latitude, loc.longitude, loc.altitude)
+    if cache_filename:
+        cache[location_name] = {
+            'position': position,
+            'address': loc.address
+        }
+        with open(cache_filename, 'w') as fp:
+            json.dump(cache, fp)
+
+    return position, loc.address.encode('utf-8')
+
+def _load_geocode_cache(cache_filename):
+    if cache_filename and os.path.exists(cache_filename):
+        try:
+            with open(cache_filename, 'r') as fp:
+                return json.load(fp)
+        except ValueError:
+            logger.warn('ignoring broken geocode cache %s', cache_filename)
+    return {}